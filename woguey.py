@@ -1,9 +1,26 @@
 #!/usr/bin/python
 
 import tcod as libtcod
+import numpy as np
 import math
+import itertools
 import textwrap
-import shelve 
+import argparse
+import select
+import os
+import zlib
+import struct
+import time
+import atexit
+import bisect
+import codecs
+import pickle
+import sys
+import logging
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import tracemalloc
+from multiprocessing import shared_memory
 
 #size of window
 SCREEN_WIDTH = 80
@@ -29,6 +46,13 @@ ROOM_MAX_SIZE = 15
 ROOM_MIN_SIZE = 5
 MAX_ROOMS = 40
 
+#cave floors
+CAVE_CHANCES = [[15, 3], [30, 6], [45, 10]] #percent chance a floor is a cave, by dungeon level
+CAVE_ROCK_CHANCE = 0.45 #how much of the noise the caves are grown from starts out as rock
+CAVE_SMOOTH_STEPS = 5
+CAVE_MIN_POCKET = 8 #caves smaller than this are filled in rather than tunneled to
+CAVE_CHUNK = 15 #caves are stocked with monsters and items in squares this big
+
 #spell values
 HEAL_AMOUNT = 40
 TWERKING_DAMAGE = 40
@@ -49,14 +73,245 @@ FOV_ALGO = 0 #pick fov algorithm
 FOV_LIGHT_WALLS = True #light walls or not
 TORCH_RADIUS = 10
 
+#lighting
+LIGHT_AMBIENT = 0.3 #dimmest a tile in view can get
+STAIRS_LIGHT_RADIUS = 4
+
 LIMIT_FPS = 20 #20 frames per second
 
+#assets, loaded from the game folder
+FONT_FILE = 'arial12x12.png'
+MENU_BACKGROUND_FILE = 'kawaii.png'
+
+#minimap overlay, each of its cells sums up a square of map tiles
+MINIMAP_SCALE = 4
+MINIMAP_WIDTH = -(-MAP_WIDTH // MINIMAP_SCALE)
+MINIMAP_HEIGHT = -(-MAP_HEIGHT // MINIMAP_SCALE)
+MINIMAP_X = SCREEN_WIDTH - MINIMAP_WIDTH - 1
+MINIMAP_Y = 1
+MINIMAP_FLOOR_CHAR = 0x2593 #dark shade block
+MINIMAP_WALL_CHAR = 0x2591 #light shade block
+
+AUTO_MAX_TURNS = 500 #most turns one auto-explore, travel or run command takes without drawing
+REST_MAX_TURNS = 100 #most turns resting waits for hp to come back
+UNDO_TURNS = 20 #commands the debug undo can go back, 0 turns it off
+UNREACHABLE = np.iinfo(np.int32).max #distance map value for tiles no path leads to
+LEVEL_THREADS = 4 #threads sweeping a new floor's visibility while it is already being played
+
+#session recordings
+RECORD_MAGIC = b'WOGUEYREC1'
+RECORD_KEYFRAME_INTERVAL = 100 #store a full frame every this many frames, for seeking
+RECORD_COMPRESS_STEP = 16384 #bytes compressed per frame on top of the frame's own delta, a keyframe is spread over the next few
+
+#input journal, kept next to the savegame so a run can be replayed from its seed
+JOURNAL_FILE = 'savegame.input'
+JOURNAL_CHECK_TURNS = 50 #write a world fingerprint every this many turns
+
+#saving: 'journal' appends what changed every turn to a delta log and rewrites the savegame now and then,
+#'full' only writes the savegame when leaving the game
+SAVE_MODE = 'journal'
+SAVE_FILE = 'savegame'
+SAVE_LOG_FILE = 'savegame.delta'
+SAVE_LOG_MAGIC = b'WOGUEYLOG1'
+SAVE_CHECKPOINT_TURNS = 200 #rewrite the whole savegame every this many turns
+
+#live game state shared with other processes. the header starts with the magic, which holds the
+#layout version, then a seqlock counter that is odd while a frame is being written
+SHARE_MAGIC = b'WOGUEYSHM1'
+SHARE_HEADER = struct.Struct('<10s2xII4H8i')
+SHARE_SEQ_OFFSET = 12
+SHARE_MAX_OBJECTS = 1024
+SHARE_PLANES = ('wall', 'walkable', 'explored', 'visible') #uint8 [x, y] planes after the header
+SHARE_OBJECT = np.dtype([('oid', '<i4'), ('x', '<i2'), ('y', '<i2'), ('char', '<u4'), ('layer', 'u1'),
+    ('blocks', 'u1'), ('hp', '<i4'), ('max_hp', '<i4')]) #hp and max_hp are -1 for things that can't fight
+SHARE_WATCH_INTERVAL = 0.25 #seconds between polls of --watch
+
+#escape sequences understood by the terminal renderer, mapped to tcod keys
+TERMINAL_KEYS = {
+    'A': libtcod.KEY_UP, 'B': libtcod.KEY_DOWN, 'C': libtcod.KEY_RIGHT, 'D': libtcod.KEY_LEFT,
+    'H': libtcod.KEY_HOME, 'F': libtcod.KEY_END, 'E': libtcod.KEY_KP5, 'G': libtcod.KEY_KP5,
+    '1~': libtcod.KEY_HOME, '7~': libtcod.KEY_HOME, '4~': libtcod.KEY_END, '8~': libtcod.KEY_END,
+    '5~': libtcod.KEY_PAGEUP, '6~': libtcod.KEY_PAGEDOWN }
+
+TERMINAL_ESCAPE_WAIT = 0.1 #seconds to wait for the rest of an escape sequence cut off between reads
+
+#number keys act as the numpad on a terminal
+TERMINAL_DIGITS = {
+    '1': libtcod.KEY_KP1, '2': libtcod.KEY_KP2, '3': libtcod.KEY_KP3, '4': libtcod.KEY_KP4, '5': libtcod.KEY_KP5,
+    '6': libtcod.KEY_KP6, '7': libtcod.KEY_KP7, '8': libtcod.KEY_KP8, '9': libtcod.KEY_KP9 }
+
+#the command each key runs, see COMMANDS. named keys are tcod's KEY_ names without the KEY_,
+#single characters are typed ones. shift and a movement key runs that way
+KEYMAP = {
+    'UP': 'north', 'KP8': 'north', 'DOWN': 'south', 'KP2': 'south',
+    'LEFT': 'west', 'KP4': 'west', 'RIGHT': 'east', 'KP6': 'east',
+    'HOME': 'northwest', 'KP7': 'northwest', 'PAGEUP': 'northeast', 'KP9': 'northeast',
+    'END': 'southwest', 'KP1': 'southwest', 'PAGEDOWN': 'southeast', 'KP3': 'southeast',
+    'KP5': 'wait', 'g': 'pick up', 'i': 'inventory', 'd': 'drop', 'c': 'character',
+    'x': 'explore', 't': 'travel to stairs', 'z': 'rest', 'm': 'minimap', '<': 'descend', ',': 'descend',
+    'ESCAPE': 'exit', 'F2': 'memory', 'F3': 'memory dump', 'F4': 'undo' }
+
+#the way each movement command goes
+DIRECTIONS = {
+    'north': (0, -1), 'south': (0, 1), 'west': (-1, 0), 'east': (1, 0),
+    'northwest': (-1, -1), 'northeast': (1, -1), 'southwest': (-1, 1), 'southeast': (1, 1) }
+
+INPUT_MAX_LAG = 2 #keys waiting before repeats of a movement key count as stale and get dropped
+
+#render layers, drawn from first to last (remains on the floor go under all of them)
+LAYER_ITEM = 0
+LAYER_STAIRS = 1
+LAYER_ACTOR = 2
+LAYER_PLAYER = 3
+NUM_LAYERS = 4
+
+MAX_DECALS_PER_CELL = 3 #remains kept on one tile, None keeps them all
+
+#fighter stats of the player at the start of a game and of each kind of monster
+PLAYER_STATS = {'hp': 100, 'defense': 1, 'power': 2}
+MONSTER_TYPES = {
+    'daddy': {'char': 'D', 'name': 'daddy', 'hp': 100, 'defense': 10, 'power': 20, 'xp': 250},
+    'business': {'char': 'B', 'name': 'businessman', 'hp': 80, 'defense': 22, 'power': 10, 'xp': 250},
+    'perfect': {'char': 'P', 'name': 'perfect DADDY', 'hp': 300, 'defense': 12, 'power': 50, 'xp': 5000},
+    'qt': {'char': 'q', 'name': 'qt3.14', 'hp': 30, 'defense': 5, 'power': 10, 'xp': 100},
+    'nerdy': {'char': 'n', 'name': 'nerdy', 'hp': 20, 'defense': 1, 'power': 4, 'xp': 35},
+    'normie': {'char': 'o', 'name': 'normie', 'hp': 20, 'defense': 2, 'power': 2, 'xp': 45},
+    'ugly': {'char': 'u', 'name': 'ugly', 'hp': 12, 'defense': 1, 'power': 4, 'xp': 15},
+    'frogposter': {'char': 'f', 'name': 'dumb frogposter', 'hp': 15, 'defense': 1, 'power': 1, 'xp': 10} }
+
+#what each piece of equipment gives
+EQUIPMENT = {
+    'candy ring': {'slot': 'accessories', 'power_bonus': 2, 'defense_bonus': 0, 'max_hp_bonus': 0},
+    'dabbing gloves': {'slot': 'accessories', 'power_bonus': 5, 'defense_bonus': 1, 'max_hp_bonus': 10},
+    'gold ring': {'slot': 'accessories', 'power_bonus': 8, 'defense_bonus': 2, 'max_hp_bonus': 20},
+    'skirt': {'slot': 'clothes', 'power_bonus': 1, 'defense_bonus': 3, 'max_hp_bonus': 30},
+    'mini-skirt': {'slot': 'clothes', 'power_bonus': 2, 'defense_bonus': 4, 'max_hp_bonus': 50} }
+
+COMBAT_MAX_ATTACKS = 100 #the combat analysis calls fights still going after this many attacks a draw
+COMBAT_BATCH = 64 #distinct fights worked out together, bounds the analysis' memory
+
+#bytes each part of the game may take before a warning is logged, None for no limit
+MEMORY_BUDGETS = {
+    'map': 4 * 1024 * 1024,
+    'objects': 1024 * 1024,
+    'decals': 256 * 1024,
+    'inventory': 256 * 1024,
+    'messages': 64 * 1024,
+    'consoles': 1024 * 1024,
+    'fov': 512 * 1024,
+    'save': 4 * 1024 * 1024,
+    'traced': 64 * 1024 * 1024 }
+MEMORY_DUMP_FILE = 'memory.txt'
+MEMORY_TOP_SITES = 25 #allocation sites written by a memory dump
+MEMORY_TRACE_FRAMES = 5 #stack depth tracemalloc keeps for each allocation
+LOG_FILE = 'woguey.log'
+
 color_dark_wall = libtcod.dark_pink
 color_light_wall = libtcod.pink
 color_dark_ground = libtcod.darkest_pink
 color_light_ground = libtcod.lighter_pink
 
-class Tile:
+#bumped whenever the world may have changed, so cached views know to refresh
+world_version = 0
+lit_version = None #world version the light map was last computed for
+light_kernels = {} #(radius, falloff) -> brightness by distance from the source
+combat_tables_cache = None #(max attacks, dice distributions) for the combat analysis
+hover_cache = None #((mouse x, mouse y, world version), names)
+panel_shown = None #what the retained gui panel was last drawn from
+explored_version = 0 #bumped whenever tiles get explored, so distance maps know to rebuild
+fov_origin = None #where the player stood when the fov was last computed
+minimap_shown = False #toggled by the player
+minimap_drawn = None #what the minimap console was last drawn from
+
+next_oid = 0 #identifies objects in the save log
+save_log = None #SaveLog being appended to while playing
+journal = None #InputJournal being written while playing
+replay = None #JournalReplay feeding recorded input instead of the keyboard
+memory_baseline = None #tracemalloc snapshot from the start of the floor
+shared_state = None #SharedState the live game is published to, with --share
+input_queue = deque() #keys read but not acted on yet, as (vk, c, shift)
+level_pool = None #ThreadPool for the per-floor work, started on first use
+level_tasks = None #LevelTasks of the floor being played
+menu_background = None #console with the main menu's picture and title, composed on first use
+
+#set up by main(), the off-screen consoles by init_consoles()
+args = None
+con = None
+panel = None
+minimap = None
+screen = None
+terminal = None #AnsiTerminal when playing in a terminal
+recorder = None #SessionRecorder with --record
+undo_snapshots = [] #snapshots from before each of the last UNDO_TURNS commands
+
+#the globals that make up the world, as a snapshot keeps them
+SNAPSHOT_GLOBALS = ('map', 'objects', 'player', 'stairs', 'decals', 'inventory', 'game_msgs', 'rooms',
+    'visibility', 'fov_map', 'wall_plane', 'explored_plane', 'walkable_plane', 'frontier_plane',
+    'minimap_explored', 'minimap_floor', 'game_state', 'dungeon_level', 'turn_count', 'next_oid', 'level_tasks')
+
+log = logging.getLogger('woguey')
+
+class History:
+    #the undo log behind snapshots. while any snapshot is alive, tracked objects note down
+    #whatever they overwrite, so going back to a snapshot means undoing the log down to its mark
+    def __init__(self):
+        self.log = [] #(object, attribute name or None for all its containers, old value)
+        self.base = 0 #position of log[0] since the history started
+        self.snapshots = [] #alive, oldest first
+        self.touched = set() #ids of objects whose containers were noted down since the last snapshot
+
+    @property
+    def active(self):
+        return bool(self.snapshots)
+
+    def touch(self, obj):
+        #copy obj's containers before they change for the first time since the last snapshot
+        if self.snapshots and id(obj) not in self.touched:
+            self.touched.add(id(obj))
+            self.log.append((obj, None, copy_containers(obj if isinstance(obj, list) else obj.__dict__)))
+
+    def undo_to(self, mark):
+        while self.base + len(self.log) > mark:
+            (obj, name, old) = self.log.pop()
+            if name is not None:
+                obj.__dict__[name] = old
+            elif isinstance(obj, list):
+                obj[:] = old
+            else:
+                obj.__dict__.clear()
+                obj.__dict__.update(old)
+        self.touched = set()
+
+    def trim(self):
+        #nothing older than the oldest snapshot can be gone back to
+        if self.snapshots:
+            oldest = self.snapshots[0].mark
+        else:
+            oldest = self.base + len(self.log)
+        del self.log[:oldest - self.base]
+        self.base = oldest
+
+history = History()
+
+def copy_containers(value):
+    #copy plain lists, dicts and deques all the way down, sharing everything they hold
+    if type(value) is list:
+        return [copy_containers(item) for item in value]
+    if type(value) in (dict, OrderedDict):
+        return type(value)((k, copy_containers(v)) for (k, v) in value.items())
+    if type(value) is deque:
+        return deque((copy_containers(item) for item in value), value.maxlen)
+    return value
+
+class Tracked(object):
+    #an object whose attribute changes a snapshot can roll back. setting an attribute
+    #for the first time (in __init__) is not noted down, a new object has nothing to go back to
+    def __setattr__(self, name, value):
+        if history.snapshots and name in self.__dict__:
+            history.log.append((self, name, self.__dict__[name]))
+        self.__dict__[name] = value
+
+class Tile(Tracked):
     #a tile of the map and its properties
     def __init__(self, blocked, block_sight = None):
         self.blocked = blocked
@@ -77,17 +332,21 @@ class Rect:
         self.y2 = y + h
     
     def center(self):
-        center_x = (self.x1 + self.x2) / 2
-        center_y = (self.y1 + self.y2) / 2
+        center_x = (self.x1 + self.x2) // 2
+        center_y = (self.y1 + self.y2) // 2
         return (center_x, center_y)
     
     def intersect(self, other):
         #return True if rectangles intersect
         return (self.x1 <= other.x2 and self.x2 >= other.x1 and self.y1 <= other.y2 and self.y2 >= other.y1)
 
-class Object:
+class Object(Tracked):
     #generic object on the screen
-    def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None, equipment=None):
+    def __init__(self, x, y, char, name, color, blocks=False, always_visible=False, fighter=None, ai=None, item=None, equipment=None, layer=None, light=None):
+        global next_oid
+        self.oid = next_oid
+        next_oid += 1
+
         self.x = x
         self.y = y
         self.char = char
@@ -115,6 +374,18 @@ class Object:
             self.item = Item()
             self.item.owner = self
 
+        self.light = light
+        if self.light: #let the light know who carries it
+            self.light.owner = self
+
+        #items are drawn under monsters unless told otherwise
+        if layer is None:
+            if self.item and not self.fighter:
+                layer = LAYER_ITEM
+            else:
+                layer = LAYER_ACTOR
+        self.layer = layer
+
     def move(self, dx, dy):
         #move by given amount, if not blocked
         if not is_blocked(self.x + dx, self.y + dy):
@@ -138,12 +409,6 @@ class Object:
         dy = other.y - self.y
         return math.sqrt(dx ** 2 + dy ** 2)
 
-    def send_to_back(self):
-        #draw this first
-        global objects
-        objects.remove(self)
-        objects.insert(0, self)
-
     def draw(self):
         #only show if visible to player
         if (libtcod.map_is_in_fov(fov_map, self.x, self.y) or (self.always_visible and map[self.x][self.y].explored)):
@@ -155,7 +420,7 @@ class Object:
         #erase character
         libtcod.console_put_char(con, self.x, self.y, ' ', libtcod.BKGND_NONE)
 
-class Fighter:
+class Fighter(Tracked):
     #combat properties of monsters, player, npcs
     def __init__(self, hp, defense, power, xp, death_function=None):
         self.base_max_hp = hp
@@ -182,14 +447,12 @@ class Fighter:
 
     def attack(self, target):
         #battle formula
-        damage = libtcod.random_get_int(0, 0, 2) * int(1 + ((2 * self.power) / (1 + target.fighter.defense))) + libtcod.random_get_int(0, 0, 6)
+        damage = libtcod.random_get_int(rng, 0, 2) * attack_multiplier(self.power, target.fighter.defense) + libtcod.random_get_int(rng, 0, 6)
 
+        events.emit(Attack(self.owner, target, damage))
         if damage > 0:
             #make the target take damage
-            message(self.owner.name.capitalize() + ' dabs on ' + target.name + ' for ' + str(damage) + ' CUMMIES!! XD')
             target.fighter.take_damage(damage)
-        else:
-            message(self.owner.name.capitalize() + ' tries to dab on ' + target.name + ' but wasn\'t ~squishy~ enough!!')
 
     def take_damage(self, damage):
         #apply damage if possible
@@ -211,12 +474,13 @@ class Fighter:
         if self.hp > self.max_hp:
             self.hp = self.max_hp
 
-class BasicMonster:
+class BasicMonster(Tracked):
     #ai for basic monster
     def take_turn(self):
-        #if you see monster, monster sees you
+        #if you see monster, monster sees you. rule out the monsters in far away rooms
+        #before asking the exact fov
         monster = self.owner
-        if libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
+        if could_see_player(monster) and libtcod.map_is_in_fov(fov_map, monster.x, monster.y):
 
             #move towards the player if far away
             if monster.distance_to(player) >= 2:
@@ -226,7 +490,7 @@ class BasicMonster:
             elif player.fighter.hp > 0:
                 monster.fighter.attack(player)
 
-class ConfusedMonster:
+class ConfusedMonster(Tracked):
     #ai for confused monster
     def __init__(self, old_ai, num_turns=CONFUSE_NUM_TURNS):
         self.old_ai = old_ai
@@ -235,14 +499,14 @@ class ConfusedMonster:
     def take_turn(self):
         if self.num_turns > 0: #still confused
             #move in random direction
-            self.owner.move(libtcod.random_get_int(0, -1, 1), libtcod.random_get_int(0, -1, 1))
+            self.owner.move(libtcod.random_get_int(rng, -1, 1), libtcod.random_get_int(rng, -1, 1))
             self.num_turns -=1
 
         else: #restore previous ai
             self.owner.ai = self.old_ai
-            message('The ' + self.owner.name + ' is no longer confused!OWO', libtcod.red)
+            events.emit(Confusion(self.owner, False))
 
-class Item:
+class Item(Tracked):
     #an item that can be picked up and used
     def __init__(self, use_function=None):
         self.use_function = use_function
@@ -250,11 +514,12 @@ class Item:
     def pick_up(self):
         #add to player inventory and remove from map
         if len(inventory) >= 26:
-            message('Your inventory is ful!! Cannot pick up ' + self.owner.name + '!!~', libtcod.green)
+            events.emit(PickUp(self.owner, picked=False))
         else:
+            history.touch(inventory)
             inventory.append(self.owner)
             objects.remove(self.owner)
-            message('You picked up a ' + self.owner.name + '!!~~', libtcod.green)
+            events.emit(PickUp(self.owner))
 
             #special case for equipment
             equipment = self.owner.equipment
@@ -268,10 +533,11 @@ class Item:
 
         #add to the map and remove from inventory
         objects.append(self.owner)
+        history.touch(inventory)
         inventory.remove(self.owner)
         self.owner.x = player.x
         self.owner.y = player.y
-        message('You dropped a ' + self.owner.name + '!Owo', libtcod.yellow)
+        events.emit(Drop(self.owner))
 
     def use(self):
         #special case for equipment
@@ -284,9 +550,17 @@ class Item:
             message('The ' + self.owner.name + ' cannot be used, silly!!uwu')
         else:
             if self.use_function() != 'cancelled':
+                history.touch(inventory)
                 inventory.remove(self.owner) #destroy after use unless cancelled 
 
-class Equipment:
+class Light:
+    #a light source, fading out with distance
+    def __init__(self, radius, falloff=1.0, intensity=1.0):
+        self.radius = radius
+        self.falloff = falloff
+        self.intensity = intensity
+
+class Equipment(Tracked):
     #an object that can be equipped
     def __init__(self, slot, power_bonus=0, defense_bonus=0, max_hp_bonus=0):
         self.power_bonus = power_bonus
@@ -310,13 +584,1013 @@ class Equipment:
 
         #equip object and show message about it
         self.is_equipped = True
-        message('Equipped ' + self.owner.name + ' on ' + self.slot + '.', libtcod.light_green)
+        events.emit(Equip(self.owner, self.slot, True))
 
     def dequip(self):
         #dequip object and show message about it
         if not self.is_equipped: return
         self.is_equipped = False
-        message('Dequipped ' + self.owner.name + ' from ' + self.slot + '.', libtcod.light_yellow)
+        events.emit(Equip(self.owner, self.slot, False))
+
+class Message:
+    #a plain line of text for the message log
+    def __init__(self, text, color=libtcod.white):
+        self.text = text
+        self.color = color
+
+    def describe(self):
+        return (self.text, self.color)
+
+class Attack:
+    #attacker went for target, a damage of 0 is a miss
+    def __init__(self, attacker, target, damage):
+        self.attacker = attacker
+        self.target = target
+        self.damage = damage
+
+    def describe(self):
+        if self.damage > 0:
+            return (self.attacker.name.capitalize() + ' dabs on ' + self.target.name + ' for ' + str(self.damage) + ' CUMMIES!! XD', libtcod.white)
+        return (self.attacker.name.capitalize() + ' tries to dab on ' + self.target.name + ' but wasn\'t ~squishy~ enough!!', libtcod.white)
+
+class Death:
+    #entity lost all its hp, the player gains xp for it
+    def __init__(self, entity, xp):
+        self.entity = entity
+        self.xp = xp
+
+    def describe(self):
+        if self.entity is player:
+            return ('You lost your CUMMIES! UWU', libtcod.red)
+        return (self.entity.name.capitalize() + ' lost all his CUMMIES! U gain ' + str(self.xp) + ' sexy exp points.', libtcod.orange)
+
+class SpellDamage:
+    #a spell hit target for some damage
+    def __init__(self, spell, target, damage):
+        self.spell = spell
+        self.target = target
+        self.damage = damage
+
+    def describe(self):
+        if self.spell == 'gangnam':
+            return ('The ' + self.target.name + ' gets pwned for ' + str(self.damage) + ' CUMMIES!', libtcod.orange)
+        return ('You start ' + self.spell + ' on ' + self.target.name + ' and make him lose ' + str(self.damage) + ' CUMMIES!', libtcod.light_blue)
+
+class Confusion:
+    #target got confused, or came back to its senses
+    def __init__(self, target, confused):
+        self.target = target
+        self.confused = confused
+
+    def describe(self):
+        if self.confused:
+            return (self.target.name + ' is confused by your dance from the 90s?!?!', libtcod.light_green)
+        return ('The ' + self.target.name + ' is no longer confused!OWO', libtcod.red)
+
+class PickUp:
+    #the player picked up item, or had no room for it
+    def __init__(self, item, picked=True):
+        self.item = item
+        self.picked = picked
+
+    def describe(self):
+        if self.picked:
+            return ('You picked up a ' + self.item.name + '!!~~', libtcod.green)
+        return ('Your inventory is ful!! Cannot pick up ' + self.item.name + '!!~', libtcod.green)
+
+class Drop:
+    #the player dropped item
+    def __init__(self, item):
+        self.item = item
+
+    def describe(self):
+        return ('You dropped a ' + self.item.name + '!Owo', libtcod.yellow)
+
+class Equip:
+    #item was equipped or dequipped in slot
+    def __init__(self, item, slot, equipped):
+        self.item = item
+        self.slot = slot
+        self.equipped = equipped
+
+    def describe(self):
+        if self.equipped:
+            return ('Equipped ' + self.item.name + ' on ' + self.slot + '.', libtcod.light_green)
+        return ('Dequipped ' + self.item.name + ' from ' + self.slot + '.', libtcod.light_yellow)
+
+class LevelUp:
+    #the player reached a new level
+    def __init__(self, level):
+        self.level = level
+
+    def describe(self):
+        return ('You got squishier! You weached level ' + str(self.level) + '!', libtcod.yellow)
+
+class EventBus:
+    #gameplay announces what happened here, whoever cares subscribes by event type
+    def __init__(self):
+        self.handlers = {}
+
+    def subscribe(self, event_type, handler):
+        self.handlers.setdefault(event_type, []).append(handler)
+
+    def unsubscribe(self, event_type, handler):
+        self.handlers.get(event_type, []).remove(handler)
+
+    def emit(self, event):
+        for handler in self.handlers.get(type(event), ()):
+            handler(event)
+
+class MessageLog:
+    #the last MSG_HEIGHT lines of game messages. events are only turned into text
+    #when the lines are asked for, and only the newest ones that can still be seen
+    def __init__(self):
+        self.lines = []
+        self.pending = deque(maxlen=MSG_HEIGHT) #every event takes at least one line
+        self.version = 0
+
+    def notify(self, event):
+        history.touch(self)
+        self.pending.append(event)
+        self.version += 1
+
+    def add_line(self, line, color):
+        history.touch(self)
+        self.lines.append((line, color))
+        del self.lines[:-MSG_HEIGHT]
+        self.version += 1
+
+    def format_pending(self):
+        #newest first, stop as soon as the log is full
+        history.touch(self)
+        new_lines = []
+        while self.pending and len(new_lines) < MSG_HEIGHT:
+            (text, color) = self.pending.pop().describe()
+            new_lines[:0] = [(line, color) for line in textwrap.wrap(text, MSG_WIDTH)]
+        self.pending.clear()
+        self.lines = (self.lines + new_lines)[-MSG_HEIGHT:]
+
+    def __iter__(self):
+        if self.pending:
+            self.format_pending()
+        return iter(self.lines)
+
+    def __len__(self):
+        if self.pending:
+            self.format_pending()
+        return len(self.lines)
+
+    def __getstate__(self):
+        #events point into the world, only save the text they turned into
+        if self.pending:
+            self.format_pending()
+        return self.__dict__
+
+def log_event(event):
+    #the message log listens to everything that has something to say
+    game_msgs.notify(event)
+
+events = EventBus()
+for event_type in (Message, Attack, Death, SpellDamage, Confusion, PickUp, Drop, Equip, LevelUp):
+    events.subscribe(event_type, log_event)
+
+def escape_sequence_length(text):
+    #length of the escape sequence text starts with, 1 for an escape key, None while it is cut off
+    if len(text) < 2:
+        return None
+    if text[1] not in '[O':
+        return 1
+
+    #the final byte ends it
+    end = 2
+    while end < len(text) and not '@' <= text[end] <= '~':
+        end += 1
+    if end == len(text):
+        return None
+    return end + 1
+
+class AnsiTerminal:
+    #draws the screen console on a vt100/ansi terminal with truecolor, for playing without sdl
+    def __init__(self, width, height, in_fd=0, out_fd=1):
+        import termios, tty
+        self.width = width
+        self.height = height
+        self.in_fd = in_fd
+        self.out_fd = out_fd
+        self.pending = ''
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+
+        #what the terminal shows right now, None means unknown
+        self.shown_ch = None
+        self.shown_fg = None
+        self.shown_bg = None
+
+        #keys arrive one at a time and ctrl-c still works
+        self.saved_attrs = termios.tcgetattr(in_fd)
+        tty.setcbreak(in_fd)
+
+        #alternate screen, hidden cursor, mouse motion reports
+        self.write('\x1b[?1049h\x1b[?25l\x1b[?1003h\x1b[?1006h\x1b[0m\x1b[2J')
+
+    def close(self):
+        #give the terminal back the way we found it
+        import termios
+        self.write('\x1b[?1006l\x1b[?1003l\x1b[0m\x1b[?25h\x1b[?1049l')
+        termios.tcsetattr(self.in_fd, termios.TCSADRAIN, self.saved_attrs)
+
+    def write(self, text):
+        data = text.encode('utf-8')
+        while data:
+            written = os.write(self.out_fd, data)
+            data = data[written:]
+
+    def present(self, console):
+        #send only the cells that changed since the last frame
+        ch = console.ch
+        fg = console.fg
+        bg = console.bg
+        if self.shown_ch is None:
+            changed = np.ones(ch.shape, dtype=bool)
+        else:
+            changed = (ch != self.shown_ch) | (fg != self.shown_fg).any(axis=2) | (bg != self.shown_bg).any(axis=2)
+
+        ys, xs = np.nonzero(changed)
+        if len(ys) > 0:
+            out = []
+            cursor = None
+            cur_fg = None
+            cur_bg = None
+            for (y, x, c, f, b) in zip(ys.tolist(), xs.tolist(), ch[ys, xs].tolist(), fg[ys, xs].tolist(), bg[ys, xs].tolist()):
+                #move the cursor only if it isn't already there, hop forward on the same row
+                if cursor is None or cursor[0] != y:
+                    out.append('\x1b[%d;%dH' % (y + 1, x + 1))
+                elif cursor[1] != x:
+                    out.append('\x1b[%dC' % (x - cursor[1]))
+
+                #change colors only when they differ from the last cell written
+                if b != cur_bg:
+                    out.append('\x1b[48;2;%d;%d;%dm' % tuple(b))
+                    cur_bg = b
+                if c in (0, 32):
+                    out.append(' ')
+                else:
+                    if f != cur_fg:
+                        out.append('\x1b[38;2;%d;%d;%dm' % tuple(f))
+                        cur_fg = f
+                    out.append(u'%c' % c)
+
+                #the last column leaves the cursor in limbo, so force a move next time
+                if x + 1 < self.width:
+                    cursor = (y, x + 1)
+                else:
+                    cursor = None
+            self.write(u''.join(out))
+
+        self.shown_ch = ch.copy()
+        self.shown_fg = fg.copy()
+        self.shown_bg = bg.copy()
+
+    def read_more(self, timeout):
+        #add whatever arrives within timeout seconds to pending, False if nothing did. a character cut
+        #off between reads waits in the decoder for the rest of its bytes
+        if not select.select([self.in_fd], [], [], timeout)[0]:
+            return False
+        self.pending += self.decoder.decode(os.read(self.in_fd, 1024))
+        return True
+
+    def read_event(self, timeout):
+        #wait up to timeout seconds (forever if None) and return ('key', vk, c, shift), ('mouse', cx, cy) or None
+        if not self.pending:
+            if not self.read_more(timeout) or not self.pending:
+                return None
+
+        text = self.pending
+        if text[0] != '\x1b':
+            self.pending = text[1:]
+            char = text[0]
+            if char in TERMINAL_DIGITS:
+                return ('key', TERMINAL_DIGITS[char], ord(char), False)
+            if char in '\r\n':
+                return ('key', libtcod.KEY_ENTER, 13, False)
+            if char == '\x7f':
+                return ('key', libtcod.KEY_BACKSPACE, 8, False)
+            return ('key', libtcod.KEY_CHAR, ord(char), False)
+
+        #slow links cut sequences in two, wait a little for the rest
+        length = escape_sequence_length(text)
+        while length is None and self.read_more(TERMINAL_ESCAPE_WAIT):
+            text = self.pending
+            length = escape_sequence_length(text)
+
+        #an escape on its own is the escape key, a sequence whose rest never came is dropped
+        if length is None:
+            self.pending = ''
+            if text == '\x1b':
+                return ('key', libtcod.KEY_ESCAPE, 27, False)
+            return None
+        if length == 1:
+            self.pending = text[1:]
+            return ('key', libtcod.KEY_ESCAPE, 27, False)
+        body = text[2:length]
+        self.pending = text[length:]
+
+        if body.startswith('<') and body[-1] in 'Mm':
+            #sgr mouse report: button;column;row
+            fields = body[1:-1].split(';')
+            return ('mouse', int(fields[1]) - 1, int(fields[2]) - 1)
+
+        #modifiers come as a second parameter, 2 means shift
+        params = body[:-1].split(';')
+        shift = len(params) > 1 and params[1] == '2'
+        name = body[-1] if body[-1] != '~' else params[0] + '~'
+        if name in TERMINAL_KEYS:
+            return ('key', TERMINAL_KEYS[name], 0, shift)
+        return None
+
+class RecordingSegment:
+    #one keyframe and the deltas after it, on their way through the compressor
+    def __init__(self, first, start_time):
+        self.first = first
+        self.start_time = start_time
+        self.num_frames = 0
+        self.compressor = zlib.compressobj(1)
+        self.compressed = []
+        self.backlog = b''
+
+class SessionRecorder:
+    #records each presented frame as the cells that changed since the previous one
+    def __init__(self, filename, width, height, keyframe_interval=RECORD_KEYFRAME_INTERVAL):
+        self.file = open(filename, 'wb')
+        self.file.write(RECORD_MAGIC + struct.pack('<HHH', width, height, keyframe_interval))
+        self.width = width
+        self.height = height
+        self.keyframe_interval = keyframe_interval
+        self.start_time = time.time()
+        self.frame_count = 0
+
+        #frames are compressed together, one keyframe and its deltas per segment. they go through the
+        #compressor a bounded step at a time as they are recorded, so no frame pays for a whole keyframe
+        #or segment. a segment stays here after the next one starts until the last of it is compressed
+        self.segments = []
+
+        self.last_ch = None
+        self.last_fg = None
+        self.last_bg = None
+
+    def record(self, console):
+        ch = console.ch
+        fg = console.fg
+        bg = console.bg
+        now = time.time() - self.start_time
+
+        keyframe = self.frame_count % self.keyframe_interval == 0
+        if keyframe:
+            #start a new segment with every cell in it
+            self.segments.append(RecordingSegment(self.frame_count, now))
+            index = np.arange(self.width * self.height, dtype=np.uint32)
+        else:
+            changed = (ch != self.last_ch) | (fg != self.last_fg).any(axis=2) | (bg != self.last_bg).any(axis=2)
+            index = np.flatnonzero(changed).astype(np.uint32)
+
+        frame = b''.join([struct.pack('<dI', now, len(index)), index.tobytes(), ch.ravel()[index].astype(np.uint32).tobytes(),
+            fg.reshape(-1, 3)[index].tobytes(), bg.reshape(-1, 3)[index].tobytes()])
+        segment = self.segments[-1]
+        segment.backlog += frame
+        segment.num_frames += 1
+
+        #a keyframe is spread over the frames after it. a delta is also compressed as it comes,
+        #so a run of big deltas can't pile up
+        self.compress(RECORD_COMPRESS_STEP + (0 if keyframe else len(frame)))
+
+        self.last_ch = ch.copy()
+        self.last_fg = fg.copy()
+        self.last_bg = bg.copy()
+        self.frame_count += 1
+
+    def compress(self, budget):
+        #compress up to budget bytes, oldest segment first, writing out every segment that a newer
+        #one has followed once the last of it is compressed
+        while self.segments:
+            segment = self.segments[0]
+            step = min(budget, len(segment.backlog))
+            if step:
+                segment.compressed.append(segment.compressor.compress(segment.backlog[:step]))
+                segment.backlog = segment.backlog[step:]
+                budget -= step
+            if segment.backlog or len(self.segments) == 1:
+                break
+            self.write_segment(self.segments.pop(0))
+
+    def write_segment(self, segment):
+        #finish compressing the segment and append it to the file
+        data = b''.join(segment.compressed) + segment.compressor.compress(segment.backlog) + segment.compressor.flush()
+        self.file.write(struct.pack('<IIdI', segment.first, segment.num_frames, segment.start_time, len(data)))
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        for segment in self.segments:
+            self.write_segment(segment)
+        self.segments = []
+        self.file.close()
+
+class SessionPlayer:
+    #reads back a recording made by SessionRecorder
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        if self.file.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError(filename + ' is not a woguey recording')
+        (self.width, self.height, self.keyframe_interval) = struct.unpack('<HHH', self.file.read(6))
+
+        #only the segment headers are read up front, frames are decoded when needed
+        self.segments = []
+        self.frame_count = 0
+        header_size = struct.calcsize('<IIdI')
+        while True:
+            header = self.file.read(header_size)
+            if len(header) < header_size:
+                break
+            (first, num_frames, start_time, length) = struct.unpack('<IIdI', header)
+            self.segments.append((first, num_frames, start_time, self.file.tell(), length))
+            self.file.seek(length, 1)
+            self.frame_count = first + num_frames
+        self.segment_firsts = [segment[0] for segment in self.segments]
+        self.segment_times = [segment[2] for segment in self.segments]
+
+        self.decoded_index = None
+        self.decoded_frames = None
+        self.position = None
+        self.ch = np.zeros((self.height, self.width), dtype=np.uint32)
+        self.fg = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        self.bg = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+
+    def decode_segment(self, segment_index):
+        #split a segment into (time, cells, chars, fg, bg) per frame
+        if self.decoded_index == segment_index:
+            return self.decoded_frames
+        (first, num_frames, start_time, offset, length) = self.segments[segment_index]
+        self.file.seek(offset)
+        data = zlib.decompress(self.file.read(length))
+
+        frames = []
+        pos = 0
+        for i in range(num_frames):
+            (frame_time, count) = struct.unpack_from('<dI', data, pos)
+            pos += struct.calcsize('<dI')
+            index = np.frombuffer(data, np.uint32, count, pos)
+            pos += 4 * count
+            ch = np.frombuffer(data, np.uint32, count, pos)
+            pos += 4 * count
+            fg = np.frombuffer(data, np.uint8, 3 * count, pos).reshape(-1, 3)
+            pos += 3 * count
+            bg = np.frombuffer(data, np.uint8, 3 * count, pos).reshape(-1, 3)
+            pos += 3 * count
+            frames.append((frame_time, index, ch, fg, bg))
+
+        self.decoded_index = segment_index
+        self.decoded_frames = frames
+        return frames
+
+    def frame(self, n):
+        #return (ch, fg, bg) arrays of frame n, starting from its keyframe unless we are already close
+        segment_index = bisect.bisect_right(self.segment_firsts, n) - 1
+        first = self.segment_firsts[segment_index]
+        frames = self.decode_segment(segment_index)
+        if self.position is None or self.position > n or self.position < first:
+            start = first
+        else:
+            start = self.position + 1
+
+        for i in range(start, n + 1):
+            (frame_time, index, ch, fg, bg) = frames[i - first]
+            self.ch.ravel()[index] = ch
+            self.fg.reshape(-1, 3)[index] = fg
+            self.bg.reshape(-1, 3)[index] = bg
+        self.position = n
+        return (self.ch, self.fg, self.bg)
+
+    def frame_at(self, seconds):
+        #index of the frame shown at the given time into the recording
+        segment_index = max(0, bisect.bisect_right(self.segment_times, seconds) - 1)
+        frames = self.decode_segment(segment_index)
+        times = [frame[0] for frame in frames]
+        return self.segment_firsts[segment_index] + max(0, bisect.bisect_right(times, seconds) - 1)
+
+    def frame_time(self, n):
+        segment_index = bisect.bisect_right(self.segment_firsts, n) - 1
+        return self.decode_segment(segment_index)[n - self.segment_firsts[segment_index]][0]
+
+    def play(self, speed=1.0):
+        #show the recording on the screen, dropping frames that are due at the same time
+        #space pauses, + and - change speed, left and right jump between keyframes
+        key = libtcod.Key()
+        mouse = libtcod.Mouse()
+        position = 0.0
+        last_time = time.time()
+        paused = False
+        while self.frame_count > 0 and not window_closed():
+            now = time.time()
+            if not paused:
+                position += (now - last_time) * speed
+            last_time = now
+
+            n = self.frame_at(position)
+            (ch, fg, bg) = self.frame(n)
+            screen.ch[:] = ch
+            screen.fg[:] = fg
+            screen.bg[:] = bg
+            flush_screen()
+
+            check_for_event(key, mouse)
+            if key.vk == libtcod.KEY_ESCAPE:
+                break
+            elif key.vk == libtcod.KEY_RIGHT:
+                next_keyframe = min(n - n % self.keyframe_interval + self.keyframe_interval, self.frame_count - 1)
+                position = self.frame_time(next_keyframe)
+            elif key.vk == libtcod.KEY_LEFT:
+                previous_keyframe = max(n - n % self.keyframe_interval - self.keyframe_interval, 0)
+                position = self.frame_time(previous_keyframe)
+            elif key.c == ord(' '):
+                paused = not paused
+            elif key.c == ord('+'):
+                speed *= 2
+            elif key.c == ord('-'):
+                speed /= 2.0
+
+    def dump_text(self, n, filename):
+        #write the characters of frame n as plain text
+        (ch, fg, bg) = self.frame(n)
+        lines = []
+        for row in ch.tolist():
+            lines.append(u''.join(u'%c' % max(c, 32) for c in row).rstrip())
+        out = open(filename, 'wb')
+        out.write(u'\n'.join(lines).encode('utf-8') + b'\n')
+        out.close()
+
+    def dump_png(self, n, filename, font=FONT_FILE):
+        #render frame n with the game font and save it as a png
+        (ch, fg, bg) = self.frame(n)
+        console = libtcod.console_new(self.width, self.height)
+        console.ch[:] = ch
+        console.fg[:] = fg
+        console.bg[:] = bg
+        tileset = libtcod.tileset.load_tilesheet(font, 32, 8, libtcod.tileset.CHARMAP_TCOD)
+        write_png(filename, tileset.render(console))
+
+def write_png(filename, pixels):
+    #save an rgba array as a png file
+    (height, width) = pixels.shape[:2]
+    rows = np.zeros((height, 1 + width * 4), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    out = open(filename, 'wb')
+    out.write(b'\x89PNG\r\n\x1a\n')
+    out.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+    out.write(chunk(b'IDAT', zlib.compress(rows.tobytes())))
+    out.write(chunk(b'IEND', b''))
+    out.close()
+
+class ObjectLayers:
+    #live objects on the map, one container per render layer so draw order comes from the layer
+    def __init__(self):
+        self.layers = [OrderedDict() for i in range(NUM_LAYERS)]
+
+    def __iter__(self):
+        #straight over the layers, no copy: a loop that adds or removes objects goes over list(objects)
+        return itertools.chain.from_iterable(self.layers)
+
+    def __len__(self):
+        return sum(len(layer) for layer in self.layers)
+
+    def __contains__(self, obj):
+        return obj in self.layers[obj.layer]
+
+    def __getitem__(self, index):
+        return list(self)[index]
+
+    def index(self, obj):
+        #position in drawing order, used by the savegame
+        for (i, other) in enumerate(self):
+            if other is obj:
+                return i
+        raise ValueError('object is not on the map')
+
+    def append(self, obj):
+        history.touch(self)
+        self.layers[obj.layer][obj] = True
+
+    def remove(self, obj):
+        history.touch(self)
+        del self.layers[obj.layer][obj]
+
+class Decals:
+    #remains left on the floor, drawn and shown on hover but never seen by the game logic
+    def __init__(self, max_per_cell=MAX_DECALS_PER_CELL):
+        self.cells = {}
+        self.max_per_cell = max_per_cell
+
+    def add(self, x, y, char, name, color):
+        history.touch(self)
+        cell = self.cells.setdefault((x, y), [])
+        cell.append((char, name, color))
+
+        #the oldest remains rot away first
+        if self.max_per_cell is not None and len(cell) > self.max_per_cell:
+            del cell[0]
+
+    def names_at(self, x, y):
+        return [name for (char, name, color) in self.cells.get((x, y), ())]
+
+    def draw(self):
+        #only the newest remains on a tile are drawn, and only if visible to player
+        for ((x, y), cell) in self.cells.items():
+            if libtcod.map_is_in_fov(fov_map, x, y):
+                (char, name, color) = cell[-1]
+                libtcod.console_set_default_foreground(con, color)
+                libtcod.console_put_char(con, x, y, char, libtcod.BKGND_NONE)
+
+    def clear(self):
+        #erase all remains, like objects they are drawn again next frame if still in view
+        for (x, y) in self.cells:
+            libtcod.console_put_char(con, x, y, ' ', libtcod.BKGND_NONE)
+
+def get_level_pool():
+    global level_pool
+    if level_pool is None:
+        level_pool = ThreadPool(LEVEL_THREADS)
+        atexit.register(shutdown_level_pool)
+    return level_pool
+
+def shutdown_level_pool():
+    #let the work already handed out finish, so nothing waits on a result that never comes
+    global level_pool
+    if level_pool is not None:
+        level_pool.close()
+        level_pool.join()
+        level_pool = None
+        atexit.unregister(shutdown_level_pool)
+
+class LevelTasks:
+    #the work a new floor sets off, as named futures. pool tasks run on the level pool and get the
+    #results of the tasks they need, deferred ones run on the game thread at the start of a turn
+    #once what they need is done. nothing waits for a result until it is first used
+    def __init__(self):
+        self.futures = {}
+        self.deferred = [] #(name, function, args, needs), in the order they were added
+
+    def submit(self, name, function, args=(), needs=()):
+        #tasks go to the pool in the order they are submitted, so whatever a task needs was taken up
+        #by a worker before it and waiting on it can't hold up the pool for good
+        needed = [self.futures[need] for need in needs]
+        def run():
+            return function(*(tuple(args) + tuple(future.get() for future in needed)))
+        self.futures[name] = get_level_pool().apply_async(run)
+
+    def defer(self, name, function, args=(), needs=()):
+        self.deferred.append((name, function, args, needs))
+
+    def waiting(self, name):
+        return any(deferred[0] == name for deferred in self.deferred)
+
+    def run_deferred(self):
+        #run whatever deferred work is no longer waiting on the pool
+        for deferred in list(self.deferred):
+            (name, function, args, needs) = deferred
+            if all(self.futures[need].ready() for need in needs):
+                self.deferred.remove(deferred)
+                function(*args)
+
+def sweep_visibility(transparent, region_map, num_regions, xs, ys):
+    #which regions the floor tiles at xs, ys have in view. runs on the level pool, libtcod lets go of
+    #the interpreter while it works out each fov so the threads get to overlap
+    sees = np.zeros((num_regions, num_regions), dtype=bool)
+    for (x, y) in zip(xs, ys):
+        fov = libtcod.map.compute_fov(transparent, (x, y), TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+        seen = region_map[fov]
+        sees[region_map[x, y], seen[seen >= 0]] = True
+    return sees
+
+def combine_sweeps(*parts):
+    #a region sees another if any of its tiles has any tile of the other in view. monsters can only
+    #be aware of the player if the player could be aware of them
+    sees = np.logical_or.reduce(parts)
+    return sees | sees.T
+
+class FloorVisibility:
+    #which parts of a floor can see which, worked out once per floor. the regions are the rooms
+    #followed by the connected stretches of corridor, region_map gives each floor tile's region
+    def __init__(self, rooms, tasks=None):
+        transparent = np.array([[not tile.block_sight for tile in column] for column in map], dtype=bool)
+        walkable = np.array([[not tile.blocked for tile in column] for column in map], dtype=bool)
+
+        self.region_map = np.full((MAP_WIDTH, MAP_HEIGHT), -1, dtype=np.int16)
+        for (i, room) in enumerate(rooms):
+            self.region_map[room.x1 + 1:room.x2, room.y1 + 1:room.y2] = i
+        corridors = label_components(walkable & (self.region_map < 0))
+        self.region_map[corridors >= 0] = corridors[corridors >= 0] + len(rooms)
+        self.num_regions = int(self.region_map.max()) + 1
+
+        #the floor is swept in pieces on the level pool and they are put together there as the
+        #floor's 'visibility' task, which nothing waits for until the first question
+        if tasks is None:
+            tasks = LevelTasks()
+        (xs, ys) = np.nonzero(walkable)
+        pieces = []
+        for (i, (part_xs, part_ys)) in enumerate(zip(np.array_split(xs, LEVEL_THREADS), np.array_split(ys, LEVEL_THREADS))):
+            pieces.append('sweep ' + str(i))
+            tasks.submit(pieces[-1], sweep_visibility, (transparent, self.region_map, self.num_regions, part_xs, part_ys))
+        tasks.submit('visibility', combine_sweeps, needs=pieces)
+        self.sees = None
+        self.pending = tasks.futures['visibility']
+
+    def wait(self):
+        if self.sees is None:
+            self.sees = self.pending.get()
+            self.pending = None
+
+    def __getstate__(self):
+        self.wait()
+        return self.__dict__
+
+    def region_at(self, x, y):
+        return self.region_map[x, y]
+
+    def can_see(self, region, other):
+        self.wait()
+        return self.sees[region, other]
+
+    def could_see(self, x, y, other_x, other_y):
+        #whether one tile may be in view of another, only the exact fov can tell for sure
+        region = self.region_map[x, y]
+        other = self.region_map[other_x, other_y]
+        if region < 0 or other < 0:
+            return False
+        self.wait()
+        return self.sees[region, other]
+
+class InputJournal:
+    #timestamped record of the input a game consumed, which together with its seed replays it exactly
+    def __init__(self, filename, seed=None, resume_at=None):
+        self.filename = filename
+        if resume_at is None:
+            #a new game journals next to the journal of the savegame on disk, and only takes its
+            #place once it has a savegame of its own. the id ties journal and savegame together
+            self.file = open(filename + '.new', 'w')
+            self.start_time = time.time()
+            self.game_id = '%016x' % struct.unpack('<Q', os.urandom(8))[0]
+            self.file.write('seed %d %.3f %s\n' % (seed, self.start_time, self.game_id))
+            self.saved = False
+        else:
+            #drop whatever was recorded after the savegame we are continuing from
+            self.file = open(filename, 'r+')
+            (self.start_time, self.game_id) = journal_header(self.file.readline())
+            self.file.seek(resume_at)
+            self.file.truncate()
+            self.saved = True
+        self.file.flush()
+        self.mouse = None
+
+    def keep(self):
+        #the game was saved, from now on the savegame on disk goes with this journal
+        if self.saved:
+            return
+        self.file.close()
+        os.replace(self.filename + '.new', self.filename)
+        self.file = open(self.filename, 'a')
+        self.saved = True
+
+    def record(self, kind, *values):
+        self.file.write('%.3f %s %s\n' % (time.time() - self.start_time, kind, ' '.join(str(value) for value in values)))
+        self.file.flush()
+
+    def tell(self):
+        return self.file.tell()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def journal_header(line):
+    #(start time, game id) from the first line of a journal, the id is None in journals older than it
+    fields = line.split()
+    return (float(fields[2]), fields[3] if len(fields) > 3 else None)
+
+def journal_game_id(filename):
+    #id of the game the journal in filename belongs to, None if there is none
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as file:
+        return journal_header(file.readline())[1]
+
+class JournalReplay:
+    #hands recorded input back to the game in place of the keyboard and mouse
+    def __init__(self, filename):
+        lines = open(filename).read().splitlines()
+        self.seed = int(lines[0].split()[1])
+        self.entries = []
+        for line in lines[1:]:
+            fields = line.split()
+            if fields:
+                self.entries.append((fields[1], [int(value) for value in fields[2:]]))
+        self.position = 0
+        self.checks = 0
+
+    def peek(self):
+        #kind of the next entry, None at the end of the journal
+        if self.position < len(self.entries):
+            return self.entries[self.position][0]
+        return None
+
+    def take(self, kind):
+        if self.peek() != kind:
+            raise ValueError('replay went out of sync at entry ' + str(self.position + 1) + ': wanted ' + kind + ', journal has ' + str(self.peek()))
+        self.position += 1
+        return self.entries[self.position - 1][1]
+
+    def verify(self, fingerprint):
+        #the world must look exactly like it did when the journal was written
+        (expected,) = self.take('check')
+        if expected != fingerprint:
+            raise ValueError('replay diverged at entry ' + str(self.position) + ' (turn ' + str(turn_count) + ')')
+        self.checks += 1
+
+class SaveLog:
+    #append-only log of what changed each turn on top of the last full savegame
+    def __init__(self, filename, checkpoint):
+        self.file = open(filename, 'wb')
+        self.file.write(SAVE_LOG_MAGIC + struct.pack('<Q', checkpoint))
+        self.file.flush()
+        self.state = capture_save_state()
+        self.checkpoint_turn = turn_count
+        self.world_version = world_version
+
+    def append(self):
+        #write one record with the differences since the last one, if the world could have changed
+        if world_version == self.world_version:
+            return
+        self.world_version = world_version
+        state = capture_save_state()
+        record = diff_save_state(self.state, state)
+        self.state = state
+        if not record:
+            return
+        if journal is not None:
+            record['input'] = journal.tell()
+
+        data = pickle.dumps(record, 2)
+        self.file.write(struct.pack('<I', len(data)) + data)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def share_layout(width, height):
+    #(offset of the planes, offset of the objects, total size) of a shared state segment
+    planes = SHARE_HEADER.size
+    objects = planes + len(SHARE_PLANES) * width * height
+    return (planes, objects, objects + SHARE_MAX_OBJECTS * SHARE_OBJECT.itemsize)
+
+class SharedState:
+    #publishes the live game state into a named shared memory segment, for dashboards and the like.
+    #readers never block the game, they check the seqlock and try again if a frame changed under them
+    def __init__(self, name):
+        (planes, objects, size) = share_layout(MAP_WIDTH, MAP_HEIGHT)
+        try:
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            #left behind by a game that didn't get to clean up
+            log.warning('replacing stale shared memory segment %s', name)
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            self.memory = shared_memory.SharedMemory(name=name, create=True, size=size)
+        buf = self.memory.buf
+        self.seq = np.ndarray((1,), dtype='<u4', buffer=buf, offset=SHARE_SEQ_OFFSET)
+        self.planes = np.ndarray((len(SHARE_PLANES), MAP_WIDTH, MAP_HEIGHT), dtype=np.uint8, buffer=buf, offset=planes)
+        self.objects = np.ndarray((SHARE_MAX_OBJECTS,), dtype=SHARE_OBJECT, buffer=buf, offset=objects)
+        self.frame = 0
+        self.state = None
+
+        #readers can attach before the first frame, frame 0 is an empty one
+        SHARE_HEADER.pack_into(buf, 0, SHARE_MAGIC, 0, 0, MAP_WIDTH, MAP_HEIGHT, SHARE_MAX_OBJECTS, 0, *([0] * 8))
+
+    def publish(self):
+        #write a new frame if anything that is shared could have changed
+        state = (world_version, explored_version, turn_count, dungeon_level, len(objects))
+        if state == self.state:
+            return
+        self.state = state
+        self.frame += 1
+
+        shown = list(objects)[:SHARE_MAX_OBJECTS]
+        if len(objects) > SHARE_MAX_OBJECTS:
+            log.warning('only sharing %d of %d objects', SHARE_MAX_OBJECTS, len(objects))
+        fighter = player.fighter
+
+        #odd while writing, so readers know to wait and retry
+        self.seq[0] += 1
+        SHARE_HEADER.pack_into(self.memory.buf, 0, SHARE_MAGIC, self.seq[0], self.frame,
+            MAP_WIDTH, MAP_HEIGHT, SHARE_MAX_OBJECTS, len(shown), dungeon_level, turn_count,
+            fighter.hp, fighter.max_hp, fighter.power, fighter.defense, fighter.xp, player.level)
+        self.planes[0] = wall_plane
+        self.planes[1] = walkable_plane
+        self.planes[2] = explored_plane
+        self.planes[3] = fov_map.fov.T
+        for (i, object) in enumerate(shown):
+            if object.fighter:
+                (hp, max_hp) = (object.fighter.hp, object.fighter.max_hp)
+            else:
+                (hp, max_hp) = (-1, -1)
+            self.objects[i] = (object.oid, object.x, object.y, ord(object.char), object.layer, object.blocks, hp, max_hp)
+        self.seq[0] += 1
+
+    def close(self):
+        for view in ('seq', 'planes', 'objects'):
+            delattr(self, view)
+        self.memory.close()
+        self.memory.unlink()
+
+class SharedStateReader:
+    #reads what a SharedState publishes, from any process. planes and objects are views straight
+    #into the shared memory, good for as long as consistent() says nothing was written since begin()
+    def __init__(self, name):
+        try:
+            self.memory = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            #before python 3.13 every process using a segment has it removed when it exits,
+            #which would pull it out from under the game
+            from multiprocessing import resource_tracker
+            self.memory = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+        buf = self.memory.buf
+        header = SHARE_HEADER.unpack_from(buf, 0)
+        if header[0] != SHARE_MAGIC:
+            raise ValueError('not a woguey shared state, or from another version')
+        (width, height, max_objects) = header[3:6]
+        (planes, objects, size) = share_layout(width, height)
+        self.seq = np.ndarray((1,), dtype='<u4', buffer=buf, offset=SHARE_SEQ_OFFSET)
+        self.planes = dict(zip(SHARE_PLANES, np.ndarray((len(SHARE_PLANES), width, height), dtype=np.uint8, buffer=buf, offset=planes)))
+        self.objects = np.ndarray((max_objects,), dtype=SHARE_OBJECT, buffer=buf, offset=objects)
+
+    def begin(self):
+        #the seqlock count of a finished frame, waiting out one being written
+        while True:
+            seq = int(self.seq[0])
+            if seq % 2 == 0:
+                return seq
+            time.sleep(0)
+
+    def consistent(self, seq):
+        return int(self.seq[0]) == seq
+
+    def header(self):
+        (magic, seq, frame, width, height, max_objects, num_objects, dungeon_level, turn_count,
+            hp, max_hp, power, defense, xp, level) = SHARE_HEADER.unpack_from(self.memory.buf, 0)
+        return {'frame': frame, 'width': width, 'height': height, 'objects': num_objects,
+            'dungeon_level': dungeon_level, 'turn_count': turn_count, 'hp': hp, 'max_hp': max_hp,
+            'power': power, 'defense': defense, 'xp': xp, 'level': level}
+
+    def read(self):
+        #a consistent copy of one frame: (header, planes, objects)
+        while True:
+            seq = self.begin()
+            header = self.header()
+            planes = dict((name, plane.copy()) for (name, plane) in self.planes.items())
+            objects = self.objects[:header['objects']].copy()
+            if self.consistent(seq):
+                return (header, planes, objects)
+
+    def close(self):
+        del self.seq, self.planes, self.objects
+        self.memory.close()
+
+def watch_shared_state(name):
+    #print a line for every frame a running game publishes, until it goes away
+    try:
+        reader = SharedStateReader(name)
+    except OSError:
+        print('no game is sharing its state as ' + name)
+        return
+    frame = None
+    try:
+        while True:
+            (header, planes, objects) = reader.read()
+            if header['frame'] != frame:
+                frame = header['frame']
+                monsters = [obj for obj in objects if obj['layer'] == LAYER_ACTOR and obj['hp'] > 0]
+                print('frame %(frame)d level %(dungeon_level)d turn %(turn_count)d hp %(hp)d/%(max_hp)d xp %(xp)d' % header
+                    + ' explored %d monsters %d' % (planes['explored'].sum(), len(monsters)))
+            time.sleep(SHARE_WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
 
 def get_equipped_in_slot(slot):
     for obj in inventory:
@@ -368,11 +1642,68 @@ def create_v_tunnel(y1, y2, x):
         map[x][y].blocked = False
         map[x][y].block_sight = False
 
+def run_starts(mask):
+    #where each run of True along the rows of a 2d mask starts, counted among the True only
+    flat = mask.ravel()
+    starts = flat.copy()
+    starts[1:] &= ~flat[:-1]
+    starts[::mask.shape[1]] = flat[::mask.shape[1]]
+    return np.flatnonzero(starts[flat])
+
+def label_components(mask):
+    #number the 4-connected areas of a boolean [x, y] plane 0, 1, 2.. and everything else -1.
+    #every tile is numbered, then each straight run of tiles along y and along x takes the
+    #smallest number in it, and each tile the number of the tile its number names, until
+    #nothing changes. that takes a step for each bend in an area rather than each tile across it
+    labels = np.full(mask.shape, -1, dtype=np.intp)
+    count = int(mask.sum())
+    if not count:
+        return labels
+    labels[mask] = np.arange(count)
+    along_x = labels.T[mask.T] #tile numbers in the order the runs along x go
+    (y_starts, x_starts) = (run_starts(mask), run_starts(mask.T))
+    y_lengths = np.diff(np.append(y_starts, count))
+    x_lengths = np.diff(np.append(x_starts, count))
+
+    numbers = np.arange(count)
+    while True:
+        spread = np.repeat(np.minimum.reduceat(numbers, y_starts), y_lengths)
+        spread[along_x] = np.repeat(np.minimum.reduceat(spread[along_x], x_starts), x_lengths)
+        spread = spread[spread]
+        if (spread == numbers).all():
+            break
+        numbers = spread
+
+    #renumber from 0, in the order the areas first show up
+    (ids, numbers) = np.unique(numbers, return_inverse=True)
+    labels[mask] = numbers
+    return labels
+
 def make_map():
-    global map, objects, stairs
+    global objects, stairs, decals, visibility, level_tasks
 
     #list of objects
-    objects = [player]
+    objects = ObjectLayers()
+    objects.append(player)
+    decals = Decals()
+
+    #deeper floors are sometimes caves
+    cave_chance = from_dungeon_level(CAVE_CHANCES)
+    if cave_chance and libtcod.random_get_int(rng, 1, 100) <= cave_chance:
+        (stairs_x, stairs_y) = make_cave()
+    else:
+        (stairs_x, stairs_y) = make_rooms()
+
+    stairs = Object(stairs_x, stairs_y, '<', 'stairs', libtcod.white, always_visible=True, layer=LAYER_STAIRS, light=Light(STAIRS_LIGHT_RADIUS, falloff=2.0))
+    objects.append(stairs)
+
+    #work out once which rooms and corridors can see each other
+    level_tasks = LevelTasks()
+    visibility = FloorVisibility(rooms, level_tasks)
+
+def make_rooms():
+    #rectangular rooms joined by tunnels, returns where the stairs go
+    global map, rooms
 
     #fill map with "blocked" tiles
     map = [[ Tile(True)
@@ -384,11 +1715,11 @@ def make_map():
 
     for r in range (MAX_ROOMS):
         #random width and height
-        w = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
-        h = libtcod.random_get_int(0, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        w = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
+        h = libtcod.random_get_int(rng, ROOM_MIN_SIZE, ROOM_MAX_SIZE)
         #random position inside the map
-        x = libtcod.random_get_int(0, 0, MAP_WIDTH - w - 1)
-        y = libtcod.random_get_int(0, 0, MAP_HEIGHT - h - 1)
+        x = libtcod.random_get_int(rng, 0, MAP_WIDTH - w - 1)
+        y = libtcod.random_get_int(rng, 0, MAP_HEIGHT - h - 1)
 
         #Rect class makes rectangles easier to work
         new_room = Rect(x, y, w, h)
@@ -425,7 +1756,7 @@ def make_map():
                 (prev_x, prev_y) = rooms[num_rooms-1].center()
 
                 #toss a coin
-                if libtcod.random_get_int(0, 0, 1) == 1:
+                if libtcod.random_get_int(rng, 0, 1) == 1:
                     #first move h, then v
                     create_h_tunnel(prev_x, new_x, prev_y)
                     create_v_tunnel(prev_y, new_y, new_x)
@@ -441,14 +1772,85 @@ def make_map():
             rooms.append(new_room)
             num_rooms += 1
 
-    #create stairs at center of last room
-    stairs = Object(new_x, new_y, '<', 'stairs', libtcod.white, always_visible=True)
-    objects.append(stairs)
-    stairs.send_to_back()
+    #stairs at center of last room
+    return (new_x, new_y)
+
+def cave_plane(width, height, random_state):
+    #floor of a cave as a boolean [x, y] plane. noise is smoothed by turning every tile into rock
+    #when most of the 3x3 square around it is rock, and the other way around
+    rock = random_state.random_sample((width, height)) < CAVE_ROCK_CHANCE
+    for step in range(CAVE_SMOOTH_STEPS):
+        rock[0, :] = rock[-1, :] = rock[:, 0] = rock[:, -1] = True
+        padded = np.pad(rock, 1, mode='constant', constant_values=True).astype(np.int8)
+        count = np.zeros((width, height), dtype=np.int8)
+        for dx in range(3):
+            for dy in range(3):
+                count += padded[dx:dx + width, dy:dy + height]
+        rock = count >= 5
+    rock[0, :] = rock[-1, :] = rock[:, 0] = rock[:, -1] = True
+    floor = ~rock
+    if not floor.any():
+        return floor
+
+    #keep the biggest cave, fill in the tiny ones and dig a tunnel from each of the others
+    labels = label_components(floor)
+    sizes = np.bincount(labels[floor])
+    main = sizes.argmax()
+    keep = sizes >= CAVE_MIN_POCKET
+    keep[main] = True
+    floor[floor] = keep[labels[floor]]
+
+    #steps through the rock (but not the border) to the biggest cave, each cave is dug from its tile closest to it
+    cost = np.ones((width, height), dtype=np.int8)
+    cost[0, :] = cost[-1, :] = cost[:, 0] = cost[:, -1] = 0
+    dist = np.full((width, height), UNREACHABLE, dtype=np.int32)
+    dist[labels == main] = 0
+    libtcod.path.dijkstra2d(dist, cost, 1, 0, out=dist)
+    (xs, ys) = np.nonzero(floor & (labels != main))
+    order = np.lexsort((dist[xs, ys], labels[xs, ys]))
+    (pockets, first) = np.unique(labels[xs, ys][order], return_index=True)
+    for i in first:
+        path = libtcod.path.hillclimb2d(dist, (xs[order[i]], ys[order[i]]), True, False)
+        floor[path[:, 0], path[:, 1]] = True
+    return floor
+
+def make_cave():
+    #one big winding cave, returns where the stairs go
+    global map, rooms
+
+    #the cave is grown with numpy's generator, seeded from the game's so a floor replays the same
+    random_state = np.random.RandomState(libtcod.random_get_int(rng, 0, 2147483646))
+    floor = cave_plane(MAP_WIDTH, MAP_HEIGHT, random_state)
+    map = [[ Tile(not floor[x, y])
+        for y in range(MAP_HEIGHT) ]
+            for x in range(MAP_WIDTH) ]
+
+    #the player starts anywhere in the cave and the stairs are as far from there as it goes
+    (xs, ys) = np.nonzero(floor)
+    start = random_state.randint(len(xs))
+    (player.x, player.y) = (int(xs[start]), int(ys[start]))
+    dist = np.full((MAP_WIDTH, MAP_HEIGHT), UNREACHABLE, dtype=np.int32)
+    dist[player.x, player.y] = 0
+    libtcod.path.dijkstra2d(dist, floor.astype(np.int8), 1, 1, out=dist)
+    dist[dist == UNREACHABLE] = -1
+    (stairs_x, stairs_y) = np.unravel_index(dist.argmax(), dist.shape)
+
+    #squares of the map stand in for rooms when stocking it and working out what sees what
+    rooms = []
+    for x in range(0, MAP_WIDTH, CAVE_CHUNK):
+        for y in range(0, MAP_HEIGHT, CAVE_CHUNK):
+            (w, h) = (min(CAVE_CHUNK, MAP_WIDTH - x), min(CAVE_CHUNK, MAP_HEIGHT - y))
+            if floor[x:x + w, y:y + h].sum() * 4 >= w * h:
+                #the room inside a Rect starts one tile in from its corner
+                room = Rect(x - 1, y - 1, w + 1, h + 1)
+                place_objects(room)
+                rooms.append(room)
+
+    return (int(stairs_x), int(stairs_y))
 
 def random_choice_index(chances): #choose one option from list of chances, return the index
     #dice will land between 1 and sum of chances
-    dice = libtcod.random_get_int(0, 1, sum(chances))
+    dice = libtcod.random_get_int(rng, 1, sum(chances))
 
     #go thru all chances, keeping the sum so far
     running_sum = 0
@@ -463,8 +1865,8 @@ def random_choice_index(chances): #choose one option from list of chances, retur
 
 def random_choice(chances_dict):
     #choose option from dic of chances, return key
-    chances = chances_dict.values()
-    strings = chances_dict.keys()
+    chances = list(chances_dict.values())
+    strings = list(chances_dict.keys())
 
     return strings[random_choice_index(chances)]
 
@@ -507,75 +1909,33 @@ def place_objects(room):
 
 
     #choose random number of monsters 
-    num_monsters = libtcod.random_get_int(0, 0, max_monsters)  
+    num_monsters = libtcod.random_get_int(rng, 0, max_monsters)  
 
 
     for i in range(num_monsters):
         #choose random spot for monster
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 
         #only place if tile is not blocked
         if not is_blocked(x, y):
             #chances
             choice = random_choice(monster_chances)
-            if choice == 'daddy':
-                fighter_component = Fighter(hp=100, defense=10, power=20, xp=250, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'D', 'daddy', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            if choice == 'business':
-                fighter_component = Fighter(hp=80, defense=22, power=10, xp=250, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'B', 'businessman', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
+            stats = MONSTER_TYPES[choice]
+            fighter_component = Fighter(hp=stats['hp'], defense=stats['defense'], power=stats['power'], xp=stats['xp'], death_function=monster_death)
+            ai_component = BasicMonster()
 
-            elif choice == 'perfect':
-                fighter_component = Fighter(hp=300, defense=12, power=50, xp=5000, death_function=monster_death)
-                ai_component = BasicMonster()
+            monster = Object(x, y, stats['char'], stats['name'], libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
 
-                monster = Object(x, y, 'P', 'perfect DADDY', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'qt':
-                fighter_component = Fighter(hp=30, defense=5, power=10, xp=100, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'q', 'qt3.14', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'nerdy':
-                fighter_component = Fighter(hp=20, defense=1, power=4, xp=35, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'n', 'nerdy', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'normie':
-                fighter_component = Fighter(hp=20, defense=2, power=2, xp=45, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'o', 'normie', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'ugly':
-                fighter_component = Fighter(hp=12, defense=1, power=4, xp=15, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'u', 'ugly', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-
-            elif choice == 'frogposter':
-                fighter_component = Fighter(hp=15, defense=1, power=1, xp=10, death_function=monster_death)
-                ai_component = BasicMonster()
-
-                monster = Object(x, y, 'f', 'dumb frogposter', libtcod.white, blocks = True, fighter=fighter_component, ai=ai_component)
-            
             objects.append(monster)
 
     #choose random number of items
-    num_items = libtcod.random_get_int(0, 0, max_items)
+    num_items = libtcod.random_get_int(rng, 0, max_items)
 
     for i in range(num_items):
         #choose random spot for item
-        x = libtcod.random_get_int(0, room.x1+1, room.x2-1)
-        y = libtcod.random_get_int(0, room.y1+1, room.y2-1)
+        x = libtcod.random_get_int(rng, room.x1+1, room.x2-1)
+        y = libtcod.random_get_int(rng, room.y1+1, room.y2-1)
 
         #only place if not blocked
         if not is_blocked(x, y):
@@ -584,7 +1944,7 @@ def place_objects(room):
                 #create healing potion(70% chance)
                 item_component = Item(use_function=cast_heal)
 
-                item = Object(x, y, '!', 'jello shot', libtcod.violet, item=item_component)
+                item = Object(x, y, '!', 'jello shot', libtcod.violet, item=item_component, light=Light(2, intensity=0.6))
 
             elif choice == 'twerking':
                 #create a twerking scroll(10% chance)
@@ -612,26 +1972,25 @@ def place_objects(room):
 
             elif choice == 'gloves':
                 #create gloves
-                equipment_component = Equipment(slot='accessories', power_bonus=5, defense_bonus=1, max_hp_bonus=10)
+                equipment_component = Equipment(**EQUIPMENT['dabbing gloves'])
                 item = Object(x, y, '/', 'dabbing gloves', libtcod.sky, equipment=equipment_component)
 
             elif choice == 'gold':
                 #create gold ring
-                equipment_component = Equipment(slot='accessories', power_bonus=8, defense_bonus=2, max_hp_bonus=20)
-                item = Object(x, y, '/', 'gold ring', libtcod.sky, equipment=equipment_component)
+                equipment_component = Equipment(**EQUIPMENT['gold ring'])
+                item = Object(x, y, '/', 'gold ring', libtcod.sky, equipment=equipment_component, light=Light(3, intensity=0.8))
  
             elif choice == 'skirt':
                 #create a skirt
-                equipment_component = Equipment(slot='clothes', power_bonus=1, defense_bonus=3, max_hp_bonus=30)
+                equipment_component = Equipment(**EQUIPMENT['skirt'])
                 item = Object(x, y, '[', 'skirt', libtcod.darker_orange, equipment=equipment_component)
 
             elif choice == 'mini':
                 #create a mini-skirt
-                equipment_component = Equipment(slot='clothes', power_bonus=2, defense_bonus=4, max_hp_bonus=50)
+                equipment_component = Equipment(**EQUIPMENT['mini-skirt'])
                 item = Object(x, y, '[', 'mini-skirt', libtcod.darker_orange, equipment=equipment_component)
  
-            objects.append(item)
-            item.send_to_back() #appears below other obj
+            objects.append(item) #appears below other obj
             item.always_visible = True
 
 def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
@@ -649,94 +2008,345 @@ def render_bar(x, y, total_width, name, value, maximum, bar_color, back_color):
     
     #some centered text with the values
     libtcod.console_set_default_foreground(panel, libtcod.white)
-    libtcod.console_print_ex(panel, x + total_width / 2, y, libtcod.BKGND_NONE, libtcod.CENTER, name + ': ' + str(value) + '/' + str(maximum))
+    libtcod.console_print_ex(panel, x + total_width // 2, y, libtcod.BKGND_NONE, libtcod.CENTER, name + ': ' + str(value) + '/' + str(maximum))
 
 def get_names_under_mouse():
-    global mouse 
+    global mouse, hover_cache
 
     #return string with names of all objects under mouse
     (x, y) = (mouse.cx, mouse.cy)
 
-    #create a list with the names in fov
-    names = [obj.name for obj in objects
+    #nothing to do if neither the mouse nor the world moved
+    cache_key = (x, y, world_version)
+    if hover_cache is not None and hover_cache[0] == cache_key:
+        return hover_cache[1]
+
+    #create a list with the names in fov, remains first
+    names = decals.names_at(x, y)
+    if names and not libtcod.map_is_in_fov(fov_map, x, y):
+        names = []
+    names += [obj.name for obj in objects
         if obj.x == x and obj.y == y and libtcod.map_is_in_fov(fov_map, obj.x, obj.y)]
 
-    names = ', '.join(names) #join names separated by ,
-    return names.capitalize()
+    names = ', '.join(names).capitalize() #join names separated by ,
+    hover_cache = (cache_key, names)
+    return names
+
+def light_kernel(radius, falloff):
+    #brightness around a light source by distance, worked out once per shape
+    if (radius, falloff) not in light_kernels:
+        (dx, dy) = np.ogrid[-radius:radius + 1, -radius:radius + 1]
+        distance = np.sqrt(dx ** 2 + dy ** 2)
+        light_kernels[(radius, falloff)] = np.clip(1.0 - distance / (radius + 1.0), 0.0, 1.0) ** falloff
+    return light_kernels[(radius, falloff)]
+
+def compute_light_map(visible):
+    #add up all light sources on the map into one intensity per tile, indexed [x, y] like map
+    light = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=np.float32)
+    transparent = ~wall_plane
+    for obj in objects:
+        if obj.light is None:
+            continue
+
+        #only the square the light can reach is looked at
+        r = obj.light.radius
+        (x0, x1) = (max(0, obj.x - r), min(MAP_WIDTH, obj.x + r + 1))
+        (y0, y1) = (max(0, obj.y - r), min(MAP_HEIGHT, obj.y + r + 1))
+        kernel = light_kernel(r, obj.light.falloff)[x0 - obj.x + r:x1 - obj.x + r, y0 - obj.y + r:y1 - obj.y + r]
+
+        #the player's fov is already known, other lights need their own
+        if obj == player:
+            lit = visible[x0:x1, y0:y1]
+        else:
+            lit = libtcod.map.compute_fov(transparent[x0:x1, y0:y1], (obj.x - x0, obj.y - y0), r, FOV_LIGHT_WALLS, FOV_ALGO)
+        light[x0:x1, y0:y1] += obj.light.intensity * kernel * lit
+
+    return np.minimum(light, 1.0)
+
+def recompute_fov():
+    #recompute fov around the player, the game logic needs it even when nothing is drawn
+    global fov_recompute, explored_plane, lit_version, explored_version, fov_origin
+    fov_recompute = False
+    fov_origin = (player.x, player.y)
+    libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
+
+    #since it's visible, explore it
+    visible = fov_map.fov.T
+    lit_version = None
+    (xs, ys) = np.nonzero(visible & ~explored_plane)
+    if len(xs):
+        own_planes()
+        for (x, y) in zip(xs, ys):
+            map[x][y].explored = True
+        explored_plane |= visible
+
+        #the frontier and the minimap can only have changed around the newly explored tiles
+        explored_version += 1
+        np.add.at(minimap_explored, (xs // MINIMAP_SCALE, ys // MINIMAP_SCALE), 1)
+        np.add.at(minimap_floor, (xs // MINIMAP_SCALE, ys // MINIMAP_SCALE), walkable_plane[xs, ys])
+        update_frontier(xs.min() - 1, ys.min() - 1, xs.max() + 2, ys.max() + 2)
+
+def own_planes():
+    #the planes changed in place are shared with snapshots, copy them on the first change after one
+    global explored_plane, frontier_plane, minimap_explored, minimap_floor
+    if history.active and 'planes' not in history.touched:
+        history.touched.add('planes')
+        explored_plane = explored_plane.copy()
+        frontier_plane = frontier_plane.copy()
+        minimap_explored = minimap_explored.copy()
+        minimap_floor = minimap_floor.copy()
+
+def block_sum(plane):
+    #add a [x, y] plane up over the squares of tiles that make the minimap cells
+    padded = np.zeros((MINIMAP_WIDTH * MINIMAP_SCALE, MINIMAP_HEIGHT * MINIMAP_SCALE), dtype=np.int32)
+    padded[:MAP_WIDTH, :MAP_HEIGHT] = plane
+    return padded.reshape(MINIMAP_WIDTH, MINIMAP_SCALE, MINIMAP_HEIGHT, MINIMAP_SCALE).sum(axis=(1, 3))
+
+def render_minimap():
+    #the whole floor at a glance: explored floor as solid blocks, walls seen so far shaded,
+    #lit up where in view, with the player, the stairs and visible monsters marked
+    global minimap_drawn
+    minimap_state = (world_version, explored_version, fov_origin)
+    if minimap_state != minimap_drawn:
+        minimap_drawn = minimap_state
+        visible = block_sum(fov_map.fov.T) > 0
+        floor = minimap_floor > 0
+        wall = (minimap_explored > 0) & ~floor
+
+        ch = np.where(floor, MINIMAP_FLOOR_CHAR, np.where(wall, MINIMAP_WALL_CHAR, ord(' ')))
+        colors = np.where(visible[..., np.newaxis],
+            np.where(floor[..., np.newaxis], np.array(color_light_ground), np.array(color_light_wall)),
+            np.where(floor[..., np.newaxis], np.array(color_dark_ground), np.array(color_dark_wall)))
+        minimap.ch[...] = ch.T
+        minimap.fg[...] = colors.transpose(1, 0, 2)
+        minimap.bg[...] = 0
+
+        #marks, the player last so it is never covered
+        marks = []
+        if map[stairs.x][stairs.y].explored:
+            marks.append((stairs.x, stairs.y, '<', libtcod.white))
+        for object in objects:
+            if object.ai and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+                marks.append((object.x, object.y, object.char, libtcod.red))
+        marks.append((player.x, player.y, '@', libtcod.white))
+        for (x, y, char, color) in marks:
+            minimap.ch[y // MINIMAP_SCALE, x // MINIMAP_SCALE] = ord(char)
+            minimap.fg[y // MINIMAP_SCALE, x // MINIMAP_SCALE] = color
+
+    libtcod.console_blit(minimap, 0, 0, MINIMAP_WIDTH, MINIMAP_HEIGHT, screen, MINIMAP_X, MINIMAP_Y)
+
+def could_see_player(obj):
+    #constant time: false means obj is surely out of the fov, which was computed from fov_origin
+    return visibility.could_see(obj.x, obj.y, fov_origin[0], fov_origin[1])
 
 def render_all():
     global fov_map, color_dark_wall, color_light_wall
     global color_dark_ground, color_light_ground
-    global fov_recompute
+    global panel_shown, lit_version
 
     if fov_recompute:
         #recompute fov if needed
-        fov_recompute = False
-        libtcod.map_compute_fov(fov_map, player.x, player.y, TORCH_RADIUS, FOV_LIGHT_WALLS, FOV_ALGO)
-
-        #go through all tiles and set their background color
-        for y in range(MAP_HEIGHT):
-            for x in range(MAP_WIDTH):
-                visible = libtcod.map_is_in_fov(fov_map, x, y)
-                wall = map[x][y].block_sight
-                if not visible:
-                    #the player can only see if explored
-                    if map[x][y].explored:
-                        if wall:
-                            libtcod.console_set_char_background(con, x, y, color_dark_wall, libtcod.BKGND_SET)
-                        else:
-                            libtcod.console_set_char_background(con, x, y, color_dark_ground, libtcod.BKGND_SET)
-                else:
-                    #it's visible
-                    if wall:
-                        libtcod.console_set_char_background(con, x, y, color_light_wall, libtcod.BKGND_SET)
-                    else:
-                        libtcod.console_set_char_background(con, x, y, color_light_ground, libtcod.BKGND_SET)
-                    #since it's visible, explore it
-                    map[x][y].explored = True
-            
-    #draw all objects in list
-    for object in objects:
-        if object != player:
+        recompute_fov()
+
+    if lit_version != world_version:
+        #light the map and blend it into the palette, all tiles in one go
+        lit_version = world_version
+        visible = fov_map.fov.T
+        light = np.maximum(compute_light_map(visible), LIGHT_AMBIENT) * visible
+
+        wall = wall_plane[..., np.newaxis]
+        dark = np.where(wall, np.array(color_dark_wall), np.array(color_dark_ground))
+        lit = np.where(wall, np.array(color_light_wall), np.array(color_light_ground))
+        colors = dark + (lit - dark) * light[..., np.newaxis]
+
+        #the player can only see if explored
+        shown = (visible | explored_plane).T
+        con.bg[shown] = colors.transpose(1, 0, 2)[shown]
+
+    #draw remains, then all objects layer by layer, so the player ends on top
+    decals.draw()
+    for layer in objects.layers:
+        for object in layer:
             object.draw()
-    player.draw()
 
-    #blit the contents of con to the root console
-    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, 0, 0, 0)
+    #blit the contents of con to the screen
+    libtcod.console_blit(con, 0, 0, MAP_WIDTH, MAP_HEIGHT, screen, 0, 0)
+    if minimap_shown:
+        render_minimap()
 
-    #prepare to render gui panel
-    libtcod.console_set_default_background(panel, libtcod.black)
-    libtcod.console_clear(panel)
+    #the panel keeps its contents between frames, only redraw it if what it shows changed
+    names = get_names_under_mouse()
+    panel_state = (game_msgs.version, player.fighter.hp, player.fighter.max_hp, dungeon_level, names)
+    if panel_state != panel_shown:
+        panel_shown = panel_state
 
-    #print game messages one line at a time
-    y = 1
-    for (line, color) in game_msgs:
-        libtcod.console_set_default_foreground(panel, color)
-        libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
-        y += 1
+        #prepare to render gui panel
+        libtcod.console_set_default_background(panel, libtcod.black)
+        libtcod.console_clear(panel)
+
+        #print game messages one line at a time
+        y = 1
+        for (line, color) in game_msgs:
+            libtcod.console_set_default_foreground(panel, color)
+            libtcod.console_print_ex(panel, MSG_X, y, libtcod.BKGND_NONE, libtcod.LEFT, line)
+            y += 1
 
-    #show the player's stats
-    render_bar(1, 1, BAR_WIDTH, 'CUMMIES', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
-    libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Club floor -' + str(dungeon_level))
+        #show the player's stats
+        render_bar(1, 1, BAR_WIDTH, 'CUMMIES', player.fighter.hp, player.fighter.max_hp, libtcod.light_red, libtcod.darker_red)
+        libtcod.console_print_ex(panel, 1, 3, libtcod.BKGND_NONE, libtcod.LEFT, 'Club floor -' + str(dungeon_level))
 
-    #display name of object under mouse
-    libtcod.console_set_default_foreground(panel, libtcod.light_gray)
-    libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, get_names_under_mouse())
+        #display name of object under mouse
+        libtcod.console_set_default_foreground(panel, libtcod.light_gray)
+        libtcod.console_print_ex(panel, 1, 0, libtcod.BKGND_NONE, libtcod.LEFT, names)
 
-    #blit contents of panel to root console
-    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, 0, 0, PANEL_Y)
+    #blit contents of panel to the screen
+    libtcod.console_blit(panel, 0, 0, SCREEN_WIDTH, PANEL_HEIGHT, screen, 0, PANEL_Y)
 
 def message(new_msg, color = libtcod.white):
-    #split message if necessary
-    new_msg_lines = textwrap.wrap(new_msg, MSG_WIDTH)
+    #a plain line of text, wrapped by the message log when it is shown
+    events.emit(Message(new_msg, color))
+
+def update_frontier(x0, y0, x1, y1):
+    #explored floor next to an unexplored tile is where exploring goes on from.
+    #only the tiles in [x0, x1) x [y0, y1) are looked at again
+    x0 = max(x0, 0)
+    y0 = max(y0, 0)
+    x1 = min(x1, MAP_WIDTH)
+    y1 = min(y1, MAP_HEIGHT)
+
+    #the explored plane around the window, with the outside of the map counting as explored
+    padded = np.ones((x1 - x0 + 2, y1 - y0 + 2), dtype=bool)
+    (px0, py0) = (max(x0 - 1, 0), max(y0 - 1, 0))
+    (px1, py1) = (min(x1 + 1, MAP_WIDTH), min(y1 + 1, MAP_HEIGHT))
+    padded[px0 - x0 + 1:px1 - x0 + 1, py0 - y0 + 1:py1 - y0 + 1] = explored_plane[px0:px1, py0:py1]
+
+    unexplored_near = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+    for dx in range(3):
+        for dy in range(3):
+            unexplored_near |= ~padded[dx:dx + x1 - x0, dy:dy + y1 - y0]
+    frontier_plane[x0:x1, y0:y1] = unexplored_near & explored_plane[x0:x1, y0:y1] & walkable_plane[x0:x1, y0:y1]
+
+def distance_map(goals):
+    #steps from every explored floor tile to the nearest goal, only walking over explored floor
+    cost = (explored_plane & walkable_plane).astype(np.int8)
+    dist = np.full((MAP_WIDTH, MAP_HEIGHT), UNREACHABLE, dtype=np.int32)
+    dist[goals] = 0
+    libtcod.path.dijkstra2d(dist, cost, 1, 1, out=dist)
+    return dist
+
+def monster_in_view():
+    for object in objects:
+        if object.ai and could_see_player(object) and libtcod.map_is_in_fov(fov_map, object.x, object.y):
+            return True
+    return False
+
+def run_turns(step, max_turns=AUTO_MAX_TURNS):
+    #take turn after turn without drawing any of them, for as long as step() acts.
+    #a monster coming into view stops it at once
+    if fov_recompute:
+        recompute_fov()
+    if monster_in_view():
+        message('Not with ~squishies~ around!! Owo', libtcod.red)
+        return 0
+
+    #the debug undo only remembers the world from before the first step if that step acts
+    before = take_snapshot() if UNDO_TURNS else None
+    turns = 0
+    while turns < max_turns and game_state == 'playing':
+        if not step():
+            break
+        if before is not None:
+            remember_turn(before)
+            before = None
+        end_turn()
+        if fov_recompute:
+            recompute_fov()
+        turns += 1
+        if monster_in_view():
+            message('A ~squishy~ shows up!', libtcod.red)
+            break
+    if before is not None:
+        release_snapshot(before)
+    return turns
+
+def travel(find_goals):
+    #walk down a distance map towards the nearest goal, rebuilding it whenever more gets explored
+    route = [None, None] #explored version the map was built for, the distance map
+
+    def step():
+        if route[0] != explored_version:
+            goals = find_goals()
+            route[0] = explored_version
+            route[1] = distance_map(goals) if goals is not None else None
+        dist = route[1]
+        if dist is None or dist[player.x, player.y] == UNREACHABLE:
+            return False
+
+        #the neighbour closest to the goal, if it is any closer than where the player stands
+        best = None
+        best_dist = dist[player.x, player.y]
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                x = player.x + dx
+                y = player.y + dy
+                if 0 <= x < MAP_WIDTH and 0 <= y < MAP_HEIGHT and dist[x, y] < best_dist and not is_blocked(x, y):
+                    best = (dx, dy)
+                    best_dist = dist[x, y]
+        if best is None:
+            return False
+        player_move_or_attack(*best)
+        return True
+
+    return run_turns(step)
+
+def open_around(x, y):
+    #floor tiles around x, y
+    return int(walkable_plane[max(x - 1, 0):x + 2, max(y - 1, 0):y + 2].sum()) - int(walkable_plane[x, y])
+
+def run(dx, dy):
+    #walk one way until the way is blocked, something lies underfoot or the walls around change,
+    #like at a side passage, a doorway or a room's edge
+    surroundings = [] #floor around the player after the first step
 
-    for line in new_msg_lines:
-        #if buffer is full, remove first line
-        if len(game_msgs) == MSG_HEIGHT:
-            del game_msgs[0]
+    def step():
+        if surroundings:
+            if open_around(player.x, player.y) != surroundings[0]:
+                return False
+            for object in objects:
+                if object is not player and object.x == player.x and object.y == player.y:
+                    return False
+        if is_blocked(player.x + dx, player.y + dy):
+            return False
+        player_move_or_attack(dx, dy)
+        if not surroundings:
+            surroundings.append(open_around(player.x, player.y))
+        return True
+
+    run_turns(step)
+
+def rest():
+    #wait until hp is full or a monster shows up
+    if player.fighter.hp >= player.fighter.max_hp:
+        message('You are already fully rested!! uwu', libtcod.light_violet)
+        return
+    run_turns(lambda: player.fighter.hp < player.fighter.max_hp, REST_MAX_TURNS)
+
+def auto_explore():
+    def find_frontier():
+        #standing on the frontier without seeing past it means there's nothing to see there
+        own_planes()
+        frontier_plane[player.x, player.y] = False
+        return frontier_plane
+
+    travel(find_frontier)
+    if not monster_in_view() and not frontier_plane.any():
+        message('Nothing left to explore!! uwu', libtcod.light_violet)
 
-        #add the new line as tuple with text and color
-        game_msgs.append( (line, color) )
+def travel_to_stairs():
+    if not map[stairs.x][stairs.y].explored:
+        message('You haven\'t found the stairs yet!', libtcod.red)
+        return
+    travel(lambda: (stairs.x, stairs.y))
 
 def player_move_or_attack(dx, dy):
     global fov_recompute
@@ -759,6 +2369,100 @@ def player_move_or_attack(dx, dy):
         player.move(dx, dy)
         fov_recompute = True
 
+def flush_screen():
+    #present the screen on whichever backend is in use, a replay shows nothing
+    if replay is not None:
+        return
+    if terminal is not None:
+        terminal.present(screen)
+    else:
+        libtcod.console_flush()
+
+def check_for_event(key, mouse):
+    #read every event waiting, without blocking, and hand over the oldest key
+    key.vk = libtcod.KEY_NONE
+    key.c = 0
+    key.shift = False
+
+    if replay is not None:
+        #the journal holds exactly the keys that were acted on
+        if replay.peek() == 'key':
+            (key.vk, key.c, shift) = replay.take('key')
+            key.shift = bool(shift)
+        elif replay.peek() == 'mouse':
+            (mouse.cx, mouse.cy) = replay.take('mouse')
+        return
+
+    if terminal is None:
+        event = libtcod.Key()
+        while True:
+            event.vk = libtcod.KEY_NONE
+            if not libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, event, mouse):
+                break
+            if event.vk != libtcod.KEY_NONE:
+                input_queue.append((event.vk, event.c, event.shift))
+    else:
+        #the terminal has no frame limiter, so waiting for input paces the frames
+        event = terminal.read_event(1.0 / LIMIT_FPS)
+        while event is not None:
+            if event[0] == 'key':
+                input_queue.append(event[1:])
+            else:
+                (mouse.cx, mouse.cy) = event[1:]
+            event = terminal.read_event(0)
+
+    coalesce_input()
+    if input_queue:
+        (key.vk, key.c, key.shift) = input_queue.popleft()
+
+    if journal is not None:
+        if key.vk != libtcod.KEY_NONE:
+            journal.record('key', key.vk, key.c, int(key.shift))
+        elif (mouse.cx, mouse.cy) != journal.mouse:
+            journal.mouse = (mouse.cx, mouse.cy)
+            journal.record('mouse', mouse.cx, mouse.cy)
+
+def coalesce_input():
+    #key repeat can outrun the frame rate, leaving the game ever further behind the keyboard.
+    #once more keys are waiting than INPUT_MAX_LAG, a movement key with the same key right
+    #after it is a stale repeat and goes, which keeps the lag to a few frames
+    i = 0
+    while len(input_queue) > INPUT_MAX_LAG and i < len(input_queue) - 1:
+        (vk, c, shift) = input_queue[i]
+        if input_queue[i + 1] == input_queue[i] and key_command(vk, c) in DIRECTIONS:
+            del input_queue[i]
+        else:
+            i += 1
+
+def wait_for_keypress():
+    #block until a key is pressed and return it. keys typed before it was asked for are dropped,
+    #so movement keys still waiting can't pick from a menu that pops up
+    if replay is not None:
+        key = libtcod.Key()
+        (key.vk, key.c, shift) = replay.take('wait')
+        key.shift = bool(shift)
+        return key
+
+    input_queue.clear()
+    if terminal is None:
+        key = libtcod.console_wait_for_keypress(True)
+    else:
+        key = libtcod.Key()
+        event = None
+        while event is None or event[0] != 'key':
+            event = terminal.read_event(None)
+        (key.vk, key.c, key.shift) = event[1:]
+
+    if journal is not None:
+        journal.record('wait', key.vk, key.c, int(key.shift))
+    return key
+
+def window_closed():
+    #a terminal has no window to close, quitting goes through the menus
+    if terminal is not None:
+        return False
+    return libtcod.console_is_window_closed()
+
 def menu(header, options, width):
     if len(options) > 26: raise ValueError('CANNOT HAVE MORE THAN 26 OPTIONS YOU SILLY WILLY!!!')
 
@@ -784,14 +2488,14 @@ def menu(header, options, width):
         y += 1
         letter_index += 1
 
-    #blit window contents to the root console
-    x = SCREEN_WIDTH/2 - width/2
-    y = SCREEN_HEIGHT/2 - height/2
-    libtcod.console_blit(window, 0, 0, width, height, 0, x, y, 1.0, 0.7)
+    #blit window contents to the screen
+    x = SCREEN_WIDTH//2 - width//2
+    y = SCREEN_HEIGHT//2 - height//2
+    libtcod.console_blit(window, 0, 0, width, height, screen, x, y, 1.0, 0.7)
 
-    #present the root console and wait for keypress
-    libtcod.console_flush()
-    key = libtcod.console_wait_for_keypress(True)
+    #present the screen and wait for keypress
+    flush_screen()
+    key = wait_for_keypress()
 
     #convert ascii code to an index, if it is an option, return it
     index = key.c - ord('a')
@@ -820,68 +2524,143 @@ def inventory_menu(header):
 def msgbox(text, width=50):
     menu(text, [], width) #use menu() as a msgbox
 
-def handle_keys():
-    global key
-
-    if key.vk == libtcod.KEY_ESCAPE:
-        return 'exit' #exit game
-
-    if game_state == 'playing':
-        #movement keys
-        if key.vk == libtcod.KEY_UP or key.vk == libtcod.KEY_KP8:
-            player_move_or_attack(0, -1)
-        elif key.vk == libtcod.KEY_DOWN or key.vk == libtcod.KEY_KP2:
-            player_move_or_attack(0, 1)
-        elif key.vk == libtcod.KEY_LEFT or key.vk == libtcod.KEY_KP4:
-            player_move_or_attack(-1, 0)
-        elif key.vk == libtcod.KEY_RIGHT or key.vk == libtcod.KEY_KP6:
-            player_move_or_attack(1, 0)
-        elif key.vk == libtcod.KEY_HOME or key.vk == libtcod.KEY_KP7:
-            player_move_or_attack(-1, -1)
-        elif key.vk == libtcod.KEY_PAGEUP or key.vk == libtcod.KEY_KP9:
-            player_move_or_attack(1, -1)
-        elif key.vk == libtcod.KEY_END or key.vk == libtcod.KEY_KP1:
-            player_move_or_attack(-1, 1)
-        elif key.vk == libtcod.KEY_PAGEDOWN or key.vk == libtcod.KEY_KP3:
-            player_move_or_attack(1, 1)
-        elif key.vk == libtcod.KEY_KP5:
-            pass  #do nothing ie wait for the monster to come to you
+def pick_up_here():
+    #pick up an item
+    for object in objects:
+        if object.x == player.x and object.y == player.y and object.item:
+            remember_turn()
+            object.item.pick_up()
+            break
+    return 'didnt-take-turn'
+
+def use_from_inventory():
+    chosen_item = inventory_menu('Pwess key next to item to use or any other to cancel! Uwu \n')
+    if chosen_item is not None:
+        remember_turn()
+        chosen_item.use()
+    return 'didnt-take-turn'
+
+def drop_from_inventory():
+    chosen_item = inventory_menu('Pwess key next to item to drop it, or any other to cancel!!OWO \n')
+    if chosen_item is not None:
+        remember_turn()
+        chosen_item.drop()
+    return 'didnt-take-turn'
+
+def show_character():
+    level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
+    msgbox('Your bio!\n\nLevel: ' + str(player.level) + '\nExperience: ' + str(player.fighter.xp) + 
+        '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum Cummies: ' + str(player.fighter.max_hp) + 
+        '\nBeauty: ' + str(player.fighter.power) + '\nStyle: ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
+    return 'didnt-take-turn'
+
+def toggle_minimap():
+    global minimap_shown
+    minimap_shown = not minimap_shown
+    return 'didnt-take-turn'
+
+def descend():
+    #go down stairs if player is on
+    if stairs.x == player.x and stairs.y == player.y:
+        remember_turn()
+        next_level()
+    return 'didnt-take-turn'
+
+def show_memory():
+    msgbox('Memory\n\n' + '\n'.join(format_memory(memory_report())), SCREEN_WIDTH - 20)
+    return 'didnt-take-turn'
+
+def write_memory_dump():
+    #write the top allocation sites to a file
+    dump_memory(MEMORY_DUMP_FILE)
+    message('Memory dump written to ' + MEMORY_DUMP_FILE, libtcod.light_gray)
+    return 'didnt-take-turn'
+
+def wait():
+    #do nothing ie wait for the monster to come to you
+    pass
+
+def quit_game():
+    return 'exit'
+
+def debug_undo():
+    #go back to before the last command
+    undo_turn()
+    return 'didnt-take-turn'
+
+def took_no_turn(command):
+    def wrapped():
+        command()
+        return 'didnt-take-turn'
+    return wrapped
+
+def move_command(dx, dy):
+    def move():
+        player_move_or_attack(dx, dy)
+    return move
+
+#what each command does: (function, whether it also works when not playing, whether the debug undo
+#remembers the world before it). commands that may turn out to do nothing, like a cancelled menu,
+#call remember_turn() themselves once they know they will act. a function returns 'didnt-take-turn'
+#if it didn't use up the player's turn, or 'exit'
+COMMANDS = {
+    'wait': (wait, False, True),
+    'pick up': (pick_up_here, False, False),
+    'inventory': (use_from_inventory, False, False),
+    'drop': (drop_from_inventory, False, False),
+    'character': (show_character, False, False),
+    'explore': (took_no_turn(auto_explore), False, False),
+    'travel to stairs': (took_no_turn(travel_to_stairs), False, False),
+    'rest': (took_no_turn(rest), False, False),
+    'minimap': (toggle_minimap, False, False),
+    'descend': (descend, False, False),
+    'exit': (quit_game, True, False),
+    'memory': (show_memory, True, False),
+    'memory dump': (write_memory_dump, True, False),
+    'undo': (debug_undo, True, False) }
+for (name, (dx, dy)) in DIRECTIONS.items():
+    COMMANDS[name] = (move_command(dx, dy), False, True)
+
+def compile_keymap(keymap):
+    #lookups from tcod key codes and from typed characters to the commands they run
+    by_vk = {}
+    by_char = {}
+    for (name, command) in keymap.items():
+        if command not in COMMANDS:
+            raise ValueError('key ' + name + ' is bound to unknown command ' + command)
+        if len(name) == 1:
+            by_char[name] = command
         else:
-            #test for other keys
-            key_char = chr(key.c)
-
-            if key_char == 'g':
-                #pick up an item
-                for object in objects: 
-                    if object.x == player.x and object.y == player.y and object.item:
-                        object.item.pick_up()
-                        break
-
-            if key_char == 'i':
-                #show inventory
-                chosen_item = inventory_menu('Pwess key next to item to use or any other to cancel! Uwu \n')
-                if chosen_item is not None:
-                    chosen_item.use()
-
-            if key_char == 'd':
-                #show inventory, if an item is selected, drop it
-                chosen_item = inventory_menu('Pwess key next to item to drop it, or any other to cancel!!OWO \n')
-                if chosen_item is not None:
-                    chosen_item.drop()
-
-            if key_char == 'c':
-                #show character information
-                level_up_xp = LEVEL_UP_BASE + player.level * LEVEL_UP_FACTOR
-                msgbox('Your bio!\n\nLevel: ' + str(player.level) + '\nExperience: ' + str(player.fighter.xp) + 
-                    '\nExperience to level up: ' + str(level_up_xp) + '\n\nMaximum Cummies: ' + str(player.fighter.max_hp) + 
-                    '\nBeauty: ' + str(player.fighter.power) + '\nStyle: ' + str(player.fighter.defense), CHARACTER_SCREEN_WIDTH)
-
-            if key_char == '<' or key_char == ',':
-                #go down stairs if player is on
-                if stairs.x == player.x and stairs.y == player.y:
-                    next_level()
+            by_vk[getattr(libtcod, 'KEY_' + name)] = command
+    return (by_vk, by_char)
+
+key_commands = compile_keymap(KEYMAP)
 
+def key_command(vk, c):
+    #the command a key runs, None if it isn't bound
+    (by_vk, by_char) = key_commands
+    command = by_vk.get(vk)
+    if command is None and c:
+        command = by_char.get(chr(c))
+    return command
+
+def handle_keys():
+    command = key_command(key.vk, key.c)
+    if command is None:
+        if game_state == 'playing':
             return 'didnt-take-turn'
+        return None
+
+    (function, anytime, undoable) = COMMANDS[command]
+    if game_state != 'playing' and not anytime:
+        return None
+
+    #shift and a movement key runs that way
+    if key.shift and command in DIRECTIONS:
+        run(*DIRECTIONS[command])
+        return 'didnt-take-turn'
+
+    return function()
 
 def check_level_up():
     #see if the player's exp is enough to levelup
@@ -890,7 +2669,7 @@ def check_level_up():
         #it is!! level up
         player.level += 1
         player.fighter.xp -= level_up_xp
-        message('You got squishier! You weached level ' + str(player.level) + '!', libtcod.yellow)
+        events.emit(LevelUp(player.level))
 
         choice = None
         while choice == None:
@@ -910,7 +2689,7 @@ def check_level_up():
 def player_death(player):
     #the game ended!
     global game_state
-    message('You lost your CUMMIES! UWU', libtcod.red)
+    events.emit(Death(player, 0))
     game_state = 'dead'
 
     #transform player into corpse
@@ -918,15 +2697,10 @@ def player_death(player):
     player.color = libtcod.dark_red
 
 def monster_death(monster):
-    #transform into corpse
-    message(monster.name.capitalize() + ' lost all his CUMMIES! U gain ' + str(monster.fighter.xp) + ' sexy exp points.', libtcod.orange)
-    monster.char = '%'
-    monster.color = libtcod.dark_red
-    monster.blocks = False
-    monster.fighter = None
-    monster.ai = None
-    monster.name = 'remains of ' + monster.name
-    monster.send_to_back()
+    #take the monster out of the game and leave its remains on the floor
+    events.emit(Death(monster, monster.fighter.xp))
+    objects.remove(monster)
+    decals.add(monster.x, monster.y, '%', 'remains of ' + monster.name, libtcod.dark_red)
 
 def closest_monster(max_range):
     #find closest enemy inside player's fov
@@ -959,7 +2733,7 @@ def cast_twerking():
         return 'cancelled'
 
     #twerk on it
-    message('You start twerking on ' + monster.name + ' and make him lose ' + str(TWERKING_DAMAGE) + ' CUMMIES!', libtcod.light_blue)
+    events.emit(SpellDamage('twerking', monster, TWERKING_DAMAGE))
     monster.fighter.take_damage(TWERKING_DAMAGE)
 
 def cast_grinding():
@@ -970,7 +2744,7 @@ def cast_grinding():
         return 'cancelled'
 
     #grind on it
-    message('You start grinding on ' + monster.name + ' and make him lose ' + str(GRINDING_DAMAGE) + ' CUMMIES!', libtcod.light_blue)
+    events.emit(SpellDamage('grinding', monster, GRINDING_DAMAGE))
     monster.fighter.take_damage(GRINDING_DAMAGE)
 
 def cast_gangnam():
@@ -982,9 +2756,10 @@ def cast_gangnam():
     #OPA OPA OPA GANGNAM STYLE
     message('Everyone suffers through your Gangnam Style within ' + str(GANGNAM_RADIUS) + ' tiles!', libtcod.orange)
 
-    for obj in objects:
+    #the dance kills, and the dead leave objects, so go over a copy
+    for obj in list(objects):
         if obj.distance_to(monster) <= GANGNAM_RADIUS and obj.fighter and obj != player:
-            message('The ' + obj.name + ' gets pwned for ' + str(GANGNAM_DAMAGE) + ' CUMMIES!', libtcod.orange)
+            events.emit(SpellDamage('gangnam', obj, GANGNAM_DAMAGE))
             obj.fighter.take_damage(GANGNAM_DAMAGE)
 
 def cast_confuse():
@@ -997,44 +2772,387 @@ def cast_confuse():
     old_ai = monster.ai
     monster.ai = ConfusedMonster(old_ai)
     monster.ai.owner = monster
-    message(monster.name + ' is confused by your dance from the 90s?!?!', libtcod.light_green)
+    events.emit(Confusion(monster, True))
+
+def attack_multiplier(power, defense):
+    #the power against defense part of the battle formula, works on numbers and numpy arrays alike
+    return 1 + (2 * power) // (1 + defense)
+
+def damage_distribution(power, defense):
+    #exact chance of each amount of damage from one attack, for any (broadcastable) arrays of
+    #attacker power and defender defense. the result gets an extra last axis indexed by damage
+    mult = attack_multiplier(np.asarray(power), np.asarray(defense))
+    damage = np.arange(2 * mult.max() + 7)
+    chances = np.zeros(mult.shape + damage.shape)
+    for a in range(3):
+        for b in range(7):
+            chances += (damage == (a * mult + b)[..., np.newaxis]) / 21.0
+    return chances
+
+def combat_tables(max_attacks):
+    #distributions of the two dice of the battle formula summed over n = 0..max_attacks attacks.
+    #damage over n attacks is mult * A(n) + B(n), and A and B don't depend on anyone's stats
+    global combat_tables_cache
+    if combat_tables_cache is not None and combat_tables_cache[0] == max_attacks:
+        return combat_tables_cache[1:]
+
+    a_chances = np.zeros((max_attacks + 1, 2 * max_attacks + 1))
+    b_chances = np.zeros((max_attacks + 1, 6 * max_attacks + 1))
+    a_chances[0, 0] = b_chances[0, 0] = 1.0
+    for n in range(1, max_attacks + 1):
+        for roll in range(3):
+            a_chances[n, roll:] += a_chances[n - 1, :a_chances.shape[1] - roll] / 3.0
+        for roll in range(7):
+            b_chances[n, roll:] += b_chances[n - 1, :b_chances.shape[1] - roll] / 7.0
+
+    #chance B(n) is at least k, with a last column of zeros for anything past the top
+    b_at_least = np.zeros((max_attacks + 1, 6 * max_attacks + 2))
+    b_at_least[:, :-1] = b_chances[:, ::-1].cumsum(axis=1)[:, ::-1]
+
+    combat_tables_cache = (max_attacks, a_chances, b_at_least)
+    return (a_chances, b_at_least)
+
+def kill_chances(mult, hp, max_attacks=COMBAT_MAX_ATTACKS):
+    #chance that hp has been taken down by n = 0..max_attacks attacks with the given multiplier.
+    #mult and hp broadcast against each other, the result gets an extra last axis indexed by n
+    (a_chances, b_at_least) = combat_tables(max_attacks)
+    (mult, hp) = np.broadcast_arrays(np.asarray(mult), np.asarray(hp))
+
+    #only work out each distinct fight once
+    (pairs, inverse) = np.unique(np.stack([mult.ravel(), hp.ravel()], axis=1), axis=0, return_inverse=True)
+    attacks = np.arange(max_attacks + 1)[np.newaxis, :, np.newaxis]
+    a = np.arange(a_chances.shape[1])
+    chances = np.empty((len(pairs), max_attacks + 1))
+    for start in range(0, len(pairs), COMBAT_BATCH):
+        (pair_mult, pair_hp) = pairs[start:start + COMBAT_BATCH].T
+        #dead after n attacks if B(n) is at least hp - mult * A(n)
+        needed = np.clip(pair_hp[:, np.newaxis] - pair_mult[:, np.newaxis] * a, 0, b_at_least.shape[1] - 1)
+        chances[start:start + COMBAT_BATCH] = (b_at_least[attacks, needed[:, np.newaxis, :]] * a_chances).sum(axis=2)
+    return chances[inverse.ravel()].reshape(mult.shape + (max_attacks + 1,))
+
+def expected_attacks(chances):
+    #mean number of attacks until dead, from kill_chances. fights longer than its
+    #max_attacks count as taking max_attacks
+    return (1.0 - chances[..., :-1]).sum(axis=-1)
+
+def equipment_loadouts():
+    #every way of wearing at most one piece of equipment in each slot
+    slots = {}
+    for name in sorted(EQUIPMENT):
+        slots.setdefault(EQUIPMENT[name]['slot'], []).append(name)
+    loadouts = [()]
+    for slot in sorted(slots):
+        loadouts = [loadout + choice for loadout in loadouts for choice in [()] + [(name,) for name in slots[slot]]]
+    return loadouts
+
+def analyze_combat(powers, defenses, max_hps, loadouts=None, max_attacks=COMBAT_MAX_ATTACKS):
+    #every monster type against every player build, made of a base power, defense and max hp
+    #from the given ranges plus an equipment loadout. the player is assumed to hit first.
+    #arrays are indexed by [monster, power, defense, max hp, loadout], minus the axes they don't depend on
+    if loadouts is None:
+        loadouts = equipment_loadouts()
+    monsters = sorted(MONSTER_TYPES)
+    monster_hp = np.array([MONSTER_TYPES[name]['hp'] for name in monsters])
+    monster_defense = np.array([MONSTER_TYPES[name]['defense'] for name in monsters])
+    monster_power = np.array([MONSTER_TYPES[name]['power'] for name in monsters])
+    bonus = np.array([[sum(EQUIPMENT[item][field] for item in loadout)
+        for field in ('power_bonus', 'defense_bonus', 'max_hp_bonus')] for loadout in loadouts]).reshape(-1, 3)
+
+    #[monster, power, loadout]
+    power = np.asarray(powers)[np.newaxis, :, np.newaxis] + bonus[np.newaxis, np.newaxis, :, 0]
+    dealt_mult = attack_multiplier(power, monster_defense[:, np.newaxis, np.newaxis])
+    kill = kill_chances(dealt_mult, monster_hp[:, np.newaxis, np.newaxis], max_attacks)
+
+    #[monster, defense, max hp, loadout]
+    defense = np.asarray(defenses)[np.newaxis, :, np.newaxis, np.newaxis] + bonus[np.newaxis, np.newaxis, np.newaxis, :, 1]
+    max_hp = np.asarray(max_hps)[np.newaxis, np.newaxis, :, np.newaxis] + bonus[np.newaxis, np.newaxis, np.newaxis, :, 2]
+    taken_mult = attack_multiplier(monster_power[:, np.newaxis, np.newaxis, np.newaxis], defense)
+    die = kill_chances(taken_mult, max_hp, max_attacks)
+
+    #the player wins by killing with attack k before the monster's attack k lands
+    killed_at = np.diff(kill, axis=-1)
+    died_at = np.diff(die, axis=-1)
+    win = np.einsum('mpln,mdhln->mpdhl', killed_at, 1.0 - die[..., :-1])
+    lose = np.einsum('mdhln,mpln->mpdhl', died_at, 1.0 - kill[..., 1:])
+
+    return {
+        'monsters': monsters,
+        'loadouts': loadouts,
+        'damage_dealt': dealt_mult + 3.0, #mean of mult * (0..2) + (0..6)
+        'damage_taken': taken_mult + 3.0,
+        'attacks_to_kill': expected_attacks(kill),
+        'attacks_to_die': expected_attacks(die),
+        'win': win,
+        'lose': lose }
+
+def print_combat_analysis():
+    #win chances of a fresh player against each monster, in every loadout
+    analysis = analyze_combat([PLAYER_STATS['power']], [PLAYER_STATS['defense']], [PLAYER_STATS['hp']])
+    print('loadout'.ljust(30) + ''.join(name[:9].rjust(10) for name in analysis['monsters']))
+    for (l, loadout) in enumerate(analysis['loadouts']):
+        row = (' + '.join(loadout) or 'nothing').ljust(30)
+        row += ''.join((str(int(round(100 * win))) + '%').rjust(10) for win in analysis['win'][:, 0, 0, 0, l])
+        print(row)
+
+def entity_state(obj):
+    #the parts of an object that change while playing on a floor
+    fighter = None
+    if obj.fighter:
+        fighter = (obj.fighter.hp, obj.fighter.base_max_hp, obj.fighter.base_power, obj.fighter.base_defense, obj.fighter.xp)
+    confused = obj.ai.num_turns if isinstance(obj.ai, ConfusedMonster) else None
+    equipped = obj.equipment.is_equipped if obj.equipment else None
+    return (obj.x, obj.y, obj.char, tuple(obj.color), obj.name, obj.blocks, fighter, confused, equipped, getattr(obj, 'level', None))
+
+def apply_entity_state(obj, changes):
+    #set the fields of entity_state() given as {position: value}
+    for (field, value) in changes.items():
+        if field == 0:
+            obj.x = value
+        elif field == 1:
+            obj.y = value
+        elif field == 2:
+            obj.char = value
+        elif field == 3:
+            obj.color = libtcod.Color(*value)
+        elif field == 4:
+            obj.name = value
+        elif field == 5:
+            obj.blocks = value
+        elif field == 6:
+            if value is None:
+                obj.fighter = None
+            else:
+                (obj.fighter.hp, obj.fighter.base_max_hp, obj.fighter.base_power, obj.fighter.base_defense, obj.fighter.xp) = value
+        elif field == 7:
+            if value is None and isinstance(obj.ai, ConfusedMonster):
+                obj.ai = obj.ai.old_ai
+            elif value is not None and isinstance(obj.ai, ConfusedMonster):
+                obj.ai.num_turns = value
+            elif value is not None:
+                obj.ai = ConfusedMonster(obj.ai, value)
+                obj.ai.owner = obj
+        elif field == 8:
+            obj.equipment.is_equipped = value
+        elif field == 9:
+            obj.level = value
+
+def capture_save_state():
+    #everything the save log compares from one turn to the next
+    entities = {}
+    for obj in objects:
+        entities[obj.oid] = entity_state(obj)
+    for obj in inventory:
+        entities[obj.oid] = entity_state(obj)
+    return {
+        'entities': entities,
+        'objects': [obj.oid for obj in objects],
+        'inventory': [obj.oid for obj in inventory],
+        'decals': dict((cell, tuple(entries)) for (cell, entries) in decals.cells.items()),
+        'game_msgs': list(game_msgs),
+        'explored': explored_plane.copy(),
+        'game_state': game_state,
+        'turn_count': turn_count }
+
+def new_messages(old, new):
+    #lines added to the message log, which only ever drops lines from the front
+    for start in range(len(old) + 1):
+        kept = old[start:]
+        if new[:len(kept)] == kept:
+            return new[len(kept):]
+
+def diff_save_state(old, new):
+    #compact record of what changed between two captured states, empty if nothing did
+    record = {}
+
+    changed = {}
+    added = []
+    for (oid, state) in new['entities'].items():
+        if oid not in old['entities']:
+            added.append(oid)
+            continue
+        fields = dict((i, value) for (i, value) in enumerate(state) if value != old['entities'][oid][i])
+        if fields:
+            changed[oid] = fields
+    if changed:
+        record['entities'] = changed
+    if added:
+        #nothing new usually appears on a floor, but keep whole objects if it does
+        everyone = dict((obj.oid, obj) for obj in objects)
+        everyone.update((obj.oid, obj) for obj in inventory)
+        record['new'] = [everyone[oid] for oid in added]
+
+    for name in ('objects', 'inventory', 'game_state', 'turn_count'):
+        if new[name] != old[name]:
+            record[name] = new[name]
+
+    decals_changed = dict((cell, entries) for (cell, entries) in new['decals'].items() if old['decals'].get(cell) != entries)
+    if decals_changed:
+        record['decals'] = decals_changed
+
+    lines = new_messages(old['game_msgs'], new['game_msgs'])
+    if lines:
+        record['game_msgs'] = [(line, tuple(color)) for (line, color) in lines]
+
+    explored = np.flatnonzero(new['explored'] & ~old['explored'])
+    if len(explored) > 0:
+        record['explored'] = explored.astype(np.uint16).tobytes()
+
+    return record
+
+def replay_save_log(checkpoint):
+    #apply the turns logged since the savegame, returns how many and where the input journal was
+    global objects, game_state, turn_count
+    if not os.path.exists(SAVE_LOG_FILE):
+        return (0, None)
+    file = open(SAVE_LOG_FILE, 'rb')
+    header = file.read(len(SAVE_LOG_MAGIC) + 8)
+    if header != SAVE_LOG_MAGIC + struct.pack('<Q', checkpoint):
+        #the log belongs to another savegame
+        file.close()
+        return (0, None)
+
+    everyone = dict((obj.oid, obj) for obj in objects)
+    everyone.update((obj.oid, obj) for obj in inventory)
+    count = 0
+    input_position = None
+    while True:
+        #a record cut short by a crash ends the log
+        size = file.read(4)
+        if len(size) < 4:
+            break
+        data = file.read(struct.unpack('<I', size)[0])
+        try:
+            record = pickle.loads(data)
+        except Exception:
+            break
+
+        for obj in record.get('new', ()):
+            everyone[obj.oid] = obj
+        for (oid, fields) in record.get('entities', {}).items():
+            apply_entity_state(everyone[oid], fields)
+        if 'objects' in record:
+            objects = ObjectLayers()
+            for oid in record['objects']:
+                objects.append(everyone[oid])
+        if 'inventory' in record:
+            inventory[:] = [everyone[oid] for oid in record['inventory']]
+        for (cell, entries) in record.get('decals', {}).items():
+            decals.cells[cell] = list(entries)
+        for (line, color) in record.get('game_msgs', ()):
+            game_msgs.add_line(line, libtcod.Color(*color))
+        for i in np.frombuffer(record.get('explored', b''), np.uint16).tolist():
+            map[i // MAP_HEIGHT][i % MAP_HEIGHT].explored = True
+        game_state = record.get('game_state', game_state)
+        turn_count = record.get('turn_count', turn_count)
+        input_position = record.get('input', input_position)
+        count += 1
 
-def save_game():
-    #open a new empty shelve (possibly overwriting an old one) to write the game data
-    file = shelve.open('savegame', 'n')
-    file['map'] = map
-    file['objects'] = objects
-    file['player_index'] = objects.index(player)  #index of player in objects list
-    file['stairs_index'] = objects.index(stairs)
-    file['inventory'] = inventory
-    file['game_msgs'] = game_msgs
-    file['game_state'] = game_state
-    file['dungeon_level'] = dungeon_level
     file.close()
+    return (count, input_position)
+
+def save_checkpoint():
+    #write the whole world and start an empty delta log on top of it
+    global save_log
+    if save_log is not None:
+        save_log.close()
+    save_log = SaveLog(SAVE_LOG_FILE, save_game())
+
+def save_game():
+    #write the game data to a new file and swap it in for the old savegame in one step, so a crash
+    #while saving leaves the old savegame whole
+    checkpoint = struct.unpack('<Q', os.urandom(8))[0]
+    if journal is not None:
+        #the savegame points into the journal, which has to be on disk first
+        journal.sync()
+        journal.keep()
+    save = {}
+    save['map'] = map
+    save['objects'] = objects
+    save['player_index'] = objects.index(player)  #index of player in objects list
+    save['stairs_index'] = objects.index(stairs)
+    save['decals'] = decals
+    save['rooms'] = rooms
+    save['visibility'] = visibility
+    save['inventory'] = inventory
+    save['game_msgs'] = game_msgs
+    save['game_state'] = game_state
+    save['dungeon_level'] = dungeon_level
+    save['rng'] = rng
+    save['turn_count'] = turn_count
+    save['journal_length'] = journal.tell() if journal is not None else None
+    save['game_id'] = journal.game_id if journal is not None else None
+    save['next_oid'] = next_oid
+    save['checkpoint'] = checkpoint
+    with open(SAVE_FILE + '.tmp', 'wb') as file:
+        pickle.dump(save, file, pickle.HIGHEST_PROTOCOL)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(SAVE_FILE + '.tmp', SAVE_FILE)
+    return checkpoint
 
 def load_game():
-    #open the previously saved shelve and load the game data
-    global map, objects, player, stairs, inventory, game_msgs, game_state, dungeon_level
+    #read the savegame and load the game data
+    global map, objects, player, stairs, decals, inventory, game_msgs, game_state, dungeon_level
+    global rng, turn_count, journal, next_oid, rooms, visibility, level_tasks
  
-    file = shelve.open('savegame', 'r')
-    map = file['map']
-    objects = file['objects']
-    player = objects[file['player_index']]  #get index of player in objects list and access it
-    stairs = objects[file['stairs_index']]
-    inventory = file['inventory']
-    game_msgs = file['game_msgs']
-    game_state = file['game_state']
-    dungeon_level = file['dungeon_level']
-    file.close()
+    forget_history()
+    level_tasks = LevelTasks()
+    with open(SAVE_FILE, 'rb') as file:
+        save = pickle.load(file)
+    map = save['map']
+    objects = save['objects']
+    player = objects[save['player_index']]  #get index of player in objects list and access it
+    stairs = objects[save['stairs_index']]
+    decals = save['decals']
+    rooms = save['rooms']
+    visibility = save['visibility']
+    inventory = save['inventory']
+    game_msgs = save['game_msgs']
+    game_state = save['game_state']
+    dungeon_level = save['dungeon_level']
+    rng = save['rng']
+    turn_count = save['turn_count']
+    journal_length = save['journal_length']
+    game_id = save['game_id']
+    next_oid = save['next_oid']
+    checkpoint = save['checkpoint']
+
+    #turns played after the savegame was written are in the delta log
+    (recovered, input_position) = replay_save_log(checkpoint)
+    if input_position is not None:
+        journal_length = input_position
  
     initialize_fov()
 
-def new_game():
+    #keep journaling where the savegame left off, unless the journal on disk is another game's
+    if journal_length is not None and game_id is not None and journal_game_id(JOURNAL_FILE) == game_id:
+        journal = InputJournal(JOURNAL_FILE, resume_at=journal_length)
+        journal.record('loaded')
+
+    if recovered:
+        #the random generator was not logged, carry on from a fresh seed the input journal knows about
+        seed = int(time.time() * 1000) % 2147483647
+        rng = libtcod.random_new_from_seed(seed)
+        if journal is not None:
+            journal.record('reseed', seed)
+
+def new_game(seed=None):
     global player, inventory, game_msgs, game_state, dungeon_level
+    global rng, turn_count, journal
+
+    forget_history()
+
+    #every run has its own seed, so it can be replayed from its input journal
+    if seed is None:
+        seed = int(time.time() * 1000) % 2147483647
+    rng = libtcod.random_new_from_seed(seed)
+    turn_count = 0
+    if replay is None:
+        journal = InputJournal(JOURNAL_FILE, seed)
 
     #create player object
-    fighter_component = Fighter(hp=100, defense=1, power=2, xp=0, death_function=player_death)
-    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component)
+    fighter_component = Fighter(xp=0, death_function=player_death, **PLAYER_STATS)
+    player = Object(0, 0, '@', 'player', libtcod.white, blocks=True, fighter=fighter_component, layer=LAYER_PLAYER, light=Light(TORCH_RADIUS))
 
     player.level = 1
 
@@ -1046,14 +3164,14 @@ def new_game():
     game_state = 'playing'
     inventory = []
 
-    #create list of game messages and colors, starts empty
-    game_msgs = []
+    #create the log of game messages, starts empty
+    game_msgs = MessageLog()
 
     #welcoming message
     message("Welcome to the BIG PARTY~~! XD DON'T LOSE YOUR CUMMIES XD uwu")
 
     #initial equipment: ring
-    equipment_component = Equipment(slot='accessories', power_bonus=2)
+    equipment_component = Equipment(**EQUIPMENT['candy ring'])
     obj = Object(0, 0, '/', 'candy ring', libtcod.sky, equipment=equipment_component)
     inventory.append(obj)
     equipment_component.equip()
@@ -1061,78 +3179,412 @@ def new_game():
 
 def next_level():
     #advance to next level
-    global dungeon_level 
+    global dungeon_level
     message('You recover some cummies as you go down the stairs', libtcod.light_violet)
-    player.fighter.heal(player.fighter.max_hp / 2)
+    player.fighter.heal(player.fighter.max_hp // 2)
 
     dungeon_level += 1
     message('You go down one room and try to find the perfect daddy', libtcod.red)
     make_map() #create a fresh new level
     initialize_fov()
 
+    #a new floor is a good moment for a full save. it and the memory report take in the whole floor,
+    #so they wait until its visibility is done and the floor is played in the meantime
+    if save_log is not None:
+        level_tasks.defer('checkpoint', save_checkpoint, needs=('visibility',))
+    level_tasks.defer('memory report', report_memory, ('floor ' + str(dungeon_level),), needs=('visibility',))
+
 def initialize_fov():
-    global fov_recompute, fov_map
+    global fov_recompute, fov_map, world_version, wall_plane, explored_plane
+    global walkable_plane, frontier_plane, explored_version, minimap_explored, minimap_floor
+    global panel_shown, hover_cache
     fov_recompute = True
+    world_version += 1
+    explored_version += 1
+
+    #the panel and hover caches may still hold another game's message log
+    panel_shown = None
+    hover_cache = None
 
-    #create the fov map, according to generated map
+    #the map as numpy planes, indexed [x, y], for the bulk drawing and pathing code
+    wall_plane = np.array([[tile.block_sight for tile in column] for column in map], dtype=bool)
+    explored_plane = np.array([[tile.explored for tile in column] for column in map], dtype=bool)
+    walkable_plane = np.array([[not tile.blocked for tile in column] for column in map], dtype=bool)
+    frontier_plane = np.zeros((MAP_WIDTH, MAP_HEIGHT), dtype=bool)
+    update_frontier(0, 0, MAP_WIDTH, MAP_HEIGHT)
+
+    #explored and explored floor tiles in each minimap cell, kept up to date by recompute_fov
+    minimap_explored = block_sum(explored_plane)
+    minimap_floor = block_sum(explored_plane & walkable_plane)
+
+    #create the fov map, according to generated map. its arrays are indexed [y, x]
     fov_map = libtcod.map_new(MAP_WIDTH, MAP_HEIGHT)
-    for y in range(MAP_HEIGHT):
-        for x in range(MAP_WIDTH):
-            libtcod.map_set_properties(fov_map, x, y, not map[x][y].block_sight, not map[x][y].blocked)
+    fov_map.transparent[:] = ~wall_plane.T
+    fov_map.walkable[:] = walkable_plane.T
 
     libtcod.console_clear(con) #unexplored areas start black 
 
+def deep_size(obj, seen):
+    #bytes taken by obj and everything it holds on to, leaving out whatever is already in seen.
+    #returns (bytes, number of python objects)
+    size = 0
+    count = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or callable(obj) or isinstance(obj, type(sys)):
+            continue #code and modules are shared, not owned
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        count += 1
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+        elif hasattr(obj, '__dict__') and not isinstance(obj, np.ndarray):
+            stack.append(obj.__dict__)
+    return (size, count)
+
+def memory_report():
+    #(part, bytes, python objects) for everything the game keeps around, each thing counted once
+    seen = set()
+    report = []
+
+    def estimate(name, things):
+        size = 0
+        count = 0
+        for thing in things:
+            if thing is not None:
+                (thing_size, thing_count) = deep_size(thing, seen)
+                size += thing_size
+                count += thing_count
+        report.append((name, size, count))
+
+    estimate('map', [map, wall_plane, explored_plane, walkable_plane, frontier_plane])
+    estimate('objects', [objects])
+    estimate('decals', [decals])
+    estimate('inventory', [inventory])
+    estimate('messages', [game_msgs])
+
+    #the consoles and the fov map keep their cells in C buffers, only the arrays over them count
+    consoles = [console for console in (con, panel, minimap, screen) if console is not None]
+    report.append(('consoles', sum(c.ch.nbytes + c.fg.nbytes + c.bg.nbytes for c in consoles), len(consoles)))
+    if visibility is not None:
+        visibility.wait() #the pending sweeps belong to the level pool, not the floor
+    (size, count) = deep_size([light_kernels, visibility], seen)
+    size += fov_map.transparent.nbytes + fov_map.walkable.nbytes + fov_map.fov.nbytes
+    report.append(('fov', size, count + 1))
+
+    estimate('save', [save_log and save_log.state, replay and replay.entries, history.log,
+        recorder and [recorder.segments, recorder.last_ch, recorder.last_fg, recorder.last_bg]])
+
+    if tracemalloc.is_tracing():
+        report.append(('traced', tracemalloc.get_traced_memory()[0], None))
+    return report
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024 or unit == 'MB':
+            break
+        size /= 1024.0
+    return str(round(size, 1)) + ' ' + unit
+
+def format_memory(report):
+    lines = []
+    for (name, size, count) in report:
+        line = name.ljust(10) + format_bytes(size).rjust(10)
+        if count is not None:
+            line += str(count).rjust(9) + ' objects'
+        lines.append(line)
+    return lines
+
+def report_memory(when):
+    #log the size of every part of the game, warn about the ones over budget
+    global memory_baseline
+    report = memory_report()
+    for line in format_memory(report):
+        log.info('memory at %s: %s', when, line)
+    for (name, size, count) in report:
+        budget = MEMORY_BUDGETS.get(name)
+        if budget is not None and size > budget:
+            log.warning('memory at %s: %s takes %s, over its budget of %s', when, name, format_bytes(size), format_bytes(budget))
+
+    #growth is measured from here on
+    if tracemalloc.is_tracing():
+        memory_baseline = tracemalloc.take_snapshot()
+    return report
+
+def dump_memory(filename):
+    #the size estimates, then the top allocation sites and what grew since the floor started
+    out = open(filename, 'w')
+    out.write('turn ' + str(turn_count) + ', floor ' + str(dungeon_level) + '\n\n')
+    for line in format_memory(memory_report()):
+        out.write(line + '\n')
+
+    if not tracemalloc.is_tracing():
+        out.write('\nallocation sites need tracemalloc, start the game with --trace-memory\n')
+    else:
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),)
+        snapshot = tracemalloc.take_snapshot().filter_traces(ignore)
+        out.write('\ntop allocation sites\n')
+        for stat in snapshot.statistics('lineno')[:MEMORY_TOP_SITES]:
+            out.write(str(stat) + '\n')
+        if memory_baseline is not None:
+            out.write('\ngrowth since the floor started\n')
+            for stat in snapshot.compare_to(memory_baseline.filter_traces(ignore), 'lineno')[:MEMORY_TOP_SITES]:
+                out.write(str(stat) + '\n')
+    out.close()
+
+def world_fingerprint():
+    #checksum of the game state, to tell whether a replay went the same way as the original
+    state = [dungeon_level, game_state, player.level, player.fighter.xp]
+    for obj in objects:
+        state.append((obj.name, obj.x, obj.y, obj.fighter.hp if obj.fighter else None))
+    state.extend(obj.name for obj in inventory)
+    return zlib.crc32(repr(state).encode('utf-8')) & 0xffffffff
+
+class Snapshot:
+    #the world at one moment, taken in O(1): where the undo log was, the globals holding the
+    #world and the random generator. everything else is shared until it changes
+    def __init__(self):
+        self.mark = history.base + len(history.log)
+        self.world = dict((name, globals()[name]) for name in SNAPSHOT_GLOBALS)
+        self.rng = libtcod.random_save(rng)
+
+def take_snapshot():
+    snapshot = Snapshot()
+    history.snapshots.append(snapshot)
+    history.touched = set()
+    return snapshot
+
+def restore_snapshot(snapshot):
+    #put the world back the way it was when snapshot was taken, dropping any snapshot taken since
+    global rng, world_version, explored_version, minimap_drawn, panel_shown, hover_cache
+    if snapshot not in history.snapshots:
+        raise ValueError('snapshot was released or undone')
+    del history.snapshots[history.snapshots.index(snapshot) + 1:]
+    history.undo_to(snapshot.mark)
+    globals().update(snapshot.world)
+    rng = libtcod.random_save(snapshot.rng)
+
+    #and everything worked out from the world, worked out again
+    world_version += 1
+    explored_version += 1
+    minimap_drawn = None
+    panel_shown = None
+    hover_cache = None
+    libtcod.console_clear(con)
+    recompute_fov()
+
+def release_snapshot(snapshot):
+    #a snapshot nobody will go back to, the log older than every other snapshot can go
+    if snapshot in history.snapshots:
+        history.snapshots.remove(snapshot)
+    history.trim()
+
+def forget_history():
+    #a new or loaded game has no past to go back to
+    del undo_snapshots[:]
+    del history.snapshots[:]
+    history.trim()
+
+def simulate(action, evaluate=world_fingerprint):
+    #try action() on the live world, return evaluate() of where it led and put everything back.
+    #none of it reaches the journal or the save log, so bots can weigh moves in the middle of a game
+    global journal, save_log
+    snapshot = take_snapshot()
+    (live_journal, live_save_log) = (journal, save_log)
+    journal = save_log = None
+    try:
+        action()
+        return evaluate()
+    finally:
+        journal = live_journal
+        save_log = live_save_log
+        restore_snapshot(snapshot)
+        release_snapshot(snapshot)
+
+def remember_turn(snapshot=None):
+    #a snapshot from before each command that changes the world, for the debug undo. a command
+    #that can only tell it acts once it has started passes the snapshot it took beforehand
+    if not UNDO_TURNS:
+        return
+    undo_snapshots.append(snapshot or take_snapshot())
+    if len(undo_snapshots) > UNDO_TURNS:
+        release_snapshot(undo_snapshots.pop(0))
+
+def undo_turn():
+    if not undo_snapshots:
+        message('Nothing to undo!', libtcod.red)
+        return
+    snapshot = undo_snapshots.pop()
+    restore_snapshot(snapshot)
+    release_snapshot(snapshot)
+    message('Time goes backwards!! owo', libtcod.light_violet)
+
+    #the delta log only knows how to go forwards, so it starts over from the world as it is now.
+    #a floor whose own full save is still to come gets that one instead
+    if save_log is not None and not level_tasks.waiting('checkpoint'):
+        save_checkpoint()
+
+def play_turn():
+    #the game logic of one frame, after the screen is drawn
+    global world_version
+
+    #catch up on what entering the floor left for later
+    level_tasks.run_deferred()
+
+    #level up if needed
+    check_level_up()
+
+    #erase all objects and remains before they move, unless nothing is being drawn
+    if replay is None:
+        decals.clear()
+        for object in objects:
+            object.clear()
+
+    #remember the world before each command that can change it, for the debug undo
+    #a run remembers it from its first step, like the other commands that take many turns
+    command = key_command(key.vk, key.c)
+    running = key.shift and command in DIRECTIONS
+    if command is not None and COMMANDS[command][2] and not running and game_state == 'playing':
+        remember_turn()
+
+    #handle keys and exit game if needed
+    player_action = handle_keys()
+    if player_action == 'exit':
+        return player_action
+
+    #the world only changes in response to keys
+    if key.vk != libtcod.KEY_NONE:
+        world_version += 1
+
+    #let monsters take their turn
+    if game_state == 'playing' and player_action != 'didnt-take-turn':
+        end_turn()
+    return player_action
+
+def end_turn():
+    #the monsters' half of a turn, after the player acted
+    global turn_count
+    for object in objects:
+        if object.ai:
+            object.ai.take_turn()
+    turn_count += 1
+
+    #every so often note down what the world looks like
+    if turn_count % JOURNAL_CHECK_TURNS == 0:
+        if journal is not None:
+            journal.record('check', world_fingerprint())
+        elif replay is not None:
+            replay.verify(world_fingerprint())
+
 def play_game():
-    global key, mouse
+    global key, mouse, journal, save_log
 
     player_action = None
 
     mouse = libtcod.Mouse()
     key = libtcod.Key()
-    while not libtcod.console_is_window_closed():
+    while not window_closed():
         
         #render the screen
-        libtcod.sys_check_for_event(libtcod.EVENT_KEY_PRESS|libtcod.EVENT_MOUSE, key, mouse)
+        check_for_event(key, mouse)
         render_all()
 
-        libtcod.console_flush()
-
-        #level up if needed
-        check_level_up()
-
-        #erase all objects before they move
-        for object in objects:
-            object.clear()
+        flush_screen()
+        if recorder is not None:
+            recorder.record(screen)
+        if shared_state is not None:
+            shared_state.publish()
 
-        #handle keys and exit game if needed
-        player_action = handle_keys()
+        player_action = play_turn()
         if player_action == 'exit':
             save_game()
             break
 
-        #let monsters take their turn
-        if game_state == 'playing' and player_action != 'didnt-take-turn':
-            for object in objects:
-                if object.ai:
-                    object.ai.take_turn()
+        #the delta log needs a full savegame to start from. it isn't written before a turn is played,
+        #so starting a new game and closing it again leaves the last savegame alone
+        if SAVE_MODE == 'journal' and save_log is None and turn_count > 0:
+            save_checkpoint()
+
+        #log what this turn changed, and fold the log into a full save now and then. a new floor
+        #gets a full save of its own, the log can't take it as a change
+        elif save_log is not None and not level_tasks.waiting('checkpoint'):
+            save_log.append()
+            if turn_count - save_log.checkpoint_turn >= SAVE_CHECKPOINT_TURNS:
+                save_checkpoint()
+
+    if save_log is not None:
+        save_log.close()
+        save_log = None
+    if journal is not None:
+        journal.close()
+        journal = None
+
+def replay_game(filename):
+    #run a journal back through the game logic without waiting for input or drawing frames
+    global replay, key, mouse, rng
+    replay = JournalReplay(filename)
+    try:
+        mouse = libtcod.Mouse()
+        key = libtcod.Key()
+        new_game(replay.seed)
+        while replay.peek() is not None:
+            #a game recovered from its delta log went on with a new seed
+            if replay.peek() == 'reseed':
+                (seed,) = replay.take('reseed')
+                rng = libtcod.random_new_from_seed(seed)
+                continue
 
-def main_menu():
-    img = libtcod.image_load('kawaii.png')
+            #the game was loaded again here, with nothing to undo
+            if replay.peek() == 'loaded':
+                replay.take('loaded')
+                forget_history()
+                continue
+
+            position = replay.position
+            check_for_event(key, mouse)
+            if fov_recompute:
+                recompute_fov()
 
-    while not libtcod.console_is_window_closed():
-        #show bkgnd img at twice the size
-        libtcod.image_blit_2x(img, 0, 0, 0)
+            #leaving to the menu saved the game, and loading it again carries on from the same state
+            play_turn()
 
-        #show game title and credits
-        libtcod.console_set_default_foreground(0, libtcod.purple)
-        libtcod.console_print_ex(0, SCREEN_WIDTH/2, SCREEN_HEIGHT/2-4, libtcod.BKGND_NONE, libtcod.CENTER, '~WOGUEY WIKEY~')
-        libtcod.console_print_ex(0, SCREEN_WIDTH/2, SCREEN_HEIGHT-2, libtcod.BKGND_NONE, libtcod.CENTER, 'by n8uv')
+            if replay.position == position:
+                raise ValueError('replay went out of sync at entry ' + str(position + 1) + ': nothing wanted the ' + str(replay.peek()))
+        return (turn_count, replay.checks)
+    finally:
+        replay = None
+        shutdown_level_pool()
+
+def compose_menu_background():
+    #the picture and title behind the main menu, drawn once and copied to the screen from then on
+    background = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+    #show bkgnd img at twice the size
+    libtcod.image_blit_2x(libtcod.image_load(MENU_BACKGROUND_FILE), background, 0, 0)
+
+    #show game title and credits
+    libtcod.console_set_default_foreground(background, libtcod.purple)
+    libtcod.console_print_ex(background, SCREEN_WIDTH//2, SCREEN_HEIGHT//2-4, libtcod.BKGND_NONE, libtcod.CENTER, '~WOGUEY WIKEY~')
+    libtcod.console_print_ex(background, SCREEN_WIDTH//2, SCREEN_HEIGHT-2, libtcod.BKGND_NONE, libtcod.CENTER, 'by n8uv')
+    return background
+
+def main_menu():
+    global menu_background
+    if menu_background is None:
+        menu_background = compose_menu_background()
+
+    while not window_closed():
+        libtcod.console_blit(menu_background, 0, 0, SCREEN_WIDTH, SCREEN_HEIGHT, screen, 0, 0)
 
         #show options and wait for the player's choice
         choice = menu('', ['Pway a new game!', 'Return to Daddy', 'Quit OwO'], 24)
 
         if choice == 0: #new game
-            new_game()
+            new_game(args.seed)
             play_game()
         if choice == 1: #load last game
             try:
@@ -1144,16 +3596,93 @@ def main_menu():
         elif choice == 2: #quit
             break
 
-libtcod.console_set_custom_font('arial12x12.png', libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
-libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, '~Woguey Wikey~', False)
-libtcod.sys_set_fps(LIMIT_FPS)
-con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
-panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
-
-main_menu()
+def init_consoles():
+    #the off-screen consoles the game draws into, and a screen to put them on. until a window
+    #or a terminal takes over the screen it is off-screen too, which is all replays and tools need
+    global con, panel, minimap, screen
+    con = libtcod.console_new(MAP_WIDTH, MAP_HEIGHT)
+    panel = libtcod.console_new(SCREEN_WIDTH, PANEL_HEIGHT)
+    minimap = libtcod.console_new(MINIMAP_WIDTH, MINIMAP_HEIGHT)
+    screen = libtcod.console_new(SCREEN_WIDTH, SCREEN_HEIGHT)
+
+def main(argv=None):
+    global args, screen, terminal, recorder, shared_state
+
+    parser = argparse.ArgumentParser(description='~Woguey Wikey~')
+    parser.add_argument('--terminal', action='store_true', help='play in this terminal instead of an sdl window')
+    parser.add_argument('--record', metavar='FILE', help='record the session to a file')
+    parser.add_argument('--play', metavar='FILE', help='play back a recorded session')
+    parser.add_argument('--speed', type=float, default=1.0, help='playback speed multiplier')
+    parser.add_argument('--dump', metavar='FRAME', type=int, help='with --play, save one frame instead of playing')
+    parser.add_argument('--dump-to', metavar='FILE', default='frame.png', help='where --dump writes, .txt or .png')
+    parser.add_argument('--seed', type=int, help='seed for new games')
+    parser.add_argument('--replay', metavar='FILE', help='replay an input journal as fast as possible and check it')
+    parser.add_argument('--analyze-combat', action='store_true', help='print win chances of a new player against each monster')
+    parser.add_argument('--trace-memory', action='store_true', help='trace allocations, for the F3 memory dump')
+    parser.add_argument('--share', metavar='NAME', help='publish the live game state to shared memory NAME')
+    parser.add_argument('--watch', metavar='NAME', help='print the game state a running game shares as NAME')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(filename=LOG_FILE, level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    if args.trace_memory:
+        tracemalloc.start(MEMORY_TRACE_FRAMES)
+
+    if args.analyze_combat:
+        print_combat_analysis()
+        return
+
+    if args.watch:
+        watch_shared_state(args.watch)
+        return
+
+    if args.play and args.dump is not None:
+        #no window needed to dump a frame
+        player_file = SessionPlayer(args.play)
+        if args.dump_to.endswith('.txt'):
+            player_file.dump_text(args.dump, args.dump_to)
+        else:
+            player_file.dump_png(args.dump, args.dump_to)
+        return
 
+    init_consoles()
 
+    if args.replay:
+        #replays are headless, nothing is shown until the end
+        started = time.time()
+        (turns, checks) = replay_game(args.replay)
+        print('replayed ' + str(turns) + ' turns in ' + str(round(time.time() - started, 3)) + 's, ' + str(checks) + ' checkpoints matched')
+        return
 
+    if args.share:
+        shared_state = SharedState(args.share)
 
+    if args.terminal:
+        #draw off-screen and let the terminal show the differences
+        terminal = AnsiTerminal(SCREEN_WIDTH, SCREEN_HEIGHT)
+    else:
+        libtcod.console_set_custom_font(FONT_FILE, libtcod.FONT_TYPE_GREYSCALE | libtcod.FONT_LAYOUT_TCOD)
+        screen = libtcod.console_init_root(SCREEN_WIDTH, SCREEN_HEIGHT, '~Woguey Wikey~', False)
+        libtcod.sys_set_fps(LIMIT_FPS)
 
+    if args.record:
+        recorder = SessionRecorder(args.record, SCREEN_WIDTH, SCREEN_HEIGHT)
 
+    try:
+        if args.play:
+            SessionPlayer(args.play).play(args.speed)
+        else:
+            main_menu()
+    finally:
+        if recorder is not None:
+            recorder.close()
+            recorder = None
+        if terminal is not None:
+            terminal.close()
+            terminal = None
+        if shared_state is not None:
+            shared_state.close()
+            shared_state = None
+        shutdown_level_pool()
+
+if __name__ == '__main__':
+    main()